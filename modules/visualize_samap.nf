@@ -17,6 +17,7 @@
  *      results/${run_id}/plots/scatter.png
  *      results/${run_id}/csv/hms.csv 
  *      results/${run_id}/csv/pms.csv 
+ *      results/${run_id}/csv/{hms,pms}_*.csv (one pair per extra annotation)
  */
 
 process VISUALIZE_SAMAP {
@@ -40,6 +41,8 @@ process VISUALIZE_SAMAP {
         path "scatter.png"
         path "hms.csv"
         path "pms.csv"
+        path "hms_*.csv", optional: true
+        path "pms_*.csv", optional: true
         path "${run_id}_viz.log"
 
     script:
@@ -1,14 +1,15 @@
 import sklearn.utils.sparsefuncs as sf
 from . import q, ut, pd, sp, np, warnings, sc
-from .utils import to_vo, to_vn, substr, df_to_dict, sparse_knn, prepend_var_prefix
-from samalg import SAM
+from .utils import to_vo, to_vn, substr, sparse_knn, prepend_var_prefix
 from scipy.stats import rankdata
-import networkx as nx
 
-def _log_factorial(n):
-    return np.log(np.arange(1,n+1)).sum()
-def _log_binomial(n,k):
-    return _log_factorial(n) - (_log_factorial(k) + _log_factorial(n-k))
+def _gene_set_incidence(genes, terms):
+    # sparse genes x terms incidence matrix from (gene, term) entries; repeated
+    # entries are summed so that set sizes match the input lists.
+    all_genes, gix = np.unique(genes, return_inverse=True)
+    all_terms, tix = np.unique(terms, return_inverse=True)
+    M = sp.sparse.coo_matrix((np.ones(gix.size), (gix, tix)), shape=(all_genes.size, all_terms.size)).tocsc()
+    return all_genes, all_terms, M, gix, tix
 
 def GOEA(target_genes,GENE_SETS,df_key='GO',goterms=None,fdr_thresh=0.25,p_thresh=1e-3): 
     """Performs GO term Enrichment Analysis using the hypergeometric distribution.
@@ -17,7 +18,7 @@ def GOEA(target_genes,GENE_SETS,df_key='GO',goterms=None,fdr_thresh=0.25,p_thres
     ----------
     target_genes - array-like
         List of target genes from which to find enriched GO terms.
-    GENE_SETS - dictionary or pandas.DataFrame
+    GENE_SETS - dictionary, pandas.DataFrame or GeneSetIndex
         Dictionary where the keys are GO terms and the values are lists of genes associated with each GO term.
         Ex: {'GO:0000001': ['GENE_A','GENE_B'],
              'GO:0000002': ['GENE_A','GENE_C','GENE_D']}
@@ -33,6 +34,10 @@ def GOEA(target_genes,GENE_SETS,df_key='GO',goterms=None,fdr_thresh=0.25,p_thres
             ...
         If `GENE_SETS` is a pandas DataFrame, the `df_key` parameter should be the name of the column in which
         the GO terms are stored.       
+        
+        ---OR---
+        
+        A prebuilt `GeneSetIndex`, which skips building the incidence matrix.
     df_key - str, optional, default 'GO'
         The name of the column in which GO terms are stored. Only used if `GENE_SETS` is a DataFrame.
     goterms - array-list, optional, default None
@@ -47,72 +52,53 @@ def GOEA(target_genes,GENE_SETS,df_key='GO',goterms=None,fdr_thresh=0.25,p_thres
     enriched_goterms - pandas.DataFrame
         A Pandas DataFrame of enriched GO terms with FDR q values, p values, and associated genes provided.
     """    
-    
-    # identify all genes found in `GENE_SETS`
-    
-    if isinstance(GENE_SETS,pd.DataFrame):
-        print('Converting DataFrame into dictionary')
-        genes = np.array(list(GENE_SETS.index))
-        agt = np.array(list(GENE_SETS[df_key].values))
-        idx = np.argsort(agt)
-        genes = genes[idx]
-        agt = agt[idx]
-        bounds = np.where(agt[:-1]!=agt[1:])[0]+1
-        bounds = np.append(np.append(0,bounds),agt.size)
-        bounds_left=bounds[:-1]
-        bounds_right=bounds[1:]
-        genes_lists = [genes[bounds_left[i]:bounds_right[i]] for i in range(bounds_left.size)]
-        GENE_SETS = dict(zip(np.unique(agt),genes_lists))
-    all_genes = np.unique(np.concatenate(list(GENE_SETS.values())))
-    all_genes = np.array(all_genes)
+    from scipy.stats import hypergeom
+
+    # build the genes x GO terms incidence matrix
+    if isinstance(GENE_SETS,GeneSetIndex):
+        M = GENE_SETS.incidence.tocsc()
+        keep = np.asarray(M.sum(1)).flatten() > 0
+        all_genes, all_terms, M = GENE_SETS.genes[keep], GENE_SETS.terms, M[keep]
+        gix, tix = M.nonzero()
+    elif isinstance(GENE_SETS,pd.DataFrame):
+        genes = q(GENE_SETS.index)
+        agt = q(GENE_SETS[df_key].values)
+    else:
+        lists = [np.array(GENE_SETS[k]) for k in GENE_SETS.keys()]
+        genes = np.concatenate(lists) if len(lists) > 0 else np.array([])
+        agt = np.repeat(np.array(list(GENE_SETS.keys())), [x.size for x in lists])
+    if not isinstance(GENE_SETS,GeneSetIndex):
+        all_genes, all_terms, M, gix, tix = _gene_set_incidence(genes, agt)
     
     # if goterms is None, use all the goterms found in `GENE_SETS`
     if goterms is None:
-        goterms = np.unique(list(GENE_SETS.keys()))
+        goterms = all_terms
     else:
-        goterms = goterms[np.in1d(goterms,np.unique(list(GENE_SETS.keys())))]
+        goterms = goterms[np.in1d(goterms,all_terms)]
+    ixt = np.searchsorted(all_terms, goterms)
     
     # ensure that target genes are all present in `all_genes`
+    target_genes = np.array(target_genes)
     _,ix = np.unique(target_genes,return_index=True)
     target_genes=target_genes[np.sort(ix)]
     target_genes = target_genes[np.in1d(target_genes,all_genes)]
+    is_target = np.zeros(all_genes.size)
+    is_target[np.searchsorted(all_genes, target_genes)] = 1
     
-    # N -- total number of genes
+    # N -- total number of genes, n -- number of target genes
     N = all_genes.size
-
-    probs=[]
-    probs_genes=[]
-    counter=0
-    # for each go term,
-    for goterm in goterms:
-        if counter%1000==0:
-            pass; #print(counter)
-        counter+=1
-        
-        # identify genes associated with this go term
-        gene_set = np.array(GENE_SETS[goterm])
-        
-        # B -- number of genes associated with this go term
-        B = gene_set.size
-        
-        # b -- number of genes in target associated with this go term
-        gene_set_in_target = gene_set[np.in1d(gene_set,target_genes)]
-        b = gene_set_in_target.size        
-        if b != 0:
-            # calculate the enrichment probability as the cumulative sum of the tail end of a hypergeometric distribution
-            # with parameters (N,B,n,b)
-            n = target_genes.size
-            num_iter = min(n,B)
-            rng = np.arange(b,num_iter+1)
-            probs.append(sum([np.exp(_log_binomial(n,i)+_log_binomial(N-n,B-i) - _log_binomial(N,B)) for i in rng]))
-        else:
-            probs.append(1.0)
-        
-        #append associated genes to a list
-        probs_genes.append(gene_set_in_target)
-        
-    probs = np.array(probs)    
-    probs_genes = np.array([';'.join(x) for x in probs_genes])
+    n = target_genes.size
+
+    # B -- number of genes associated with each go term
+    # b -- number of genes in target associated with each go term
+    B = np.asarray(M.sum(0)).flatten()[ixt]
+    b = M.T.dot(is_target)[ixt]
+
+    # the enrichment probability is the tail end of a hypergeometric distribution
+    # with parameters (N,B,n,b)
+    probs = np.ones(goterms.size)
+    nz = b > 0
+    probs[nz] = hypergeom.sf(b[nz] - 1, N, B[nz], n)
     
     # adjust p value to correct for multiple testing
     fdr_q_probs = probs.size*probs / rankdata(probs,method='ordinal')
@@ -122,10 +108,15 @@ def GOEA(target_genes,GENE_SETS,df_key='GO',goterms=None,fdr_thresh=0.25,p_thres
     enriched_goterms = goterms[filt]
     p_values = probs[filt]
     fdr_q_probs = fdr_q_probs[filt]    
-    probs_genes=probs_genes[filt]
+
+    # associated genes of the remaining go terms, in their gene set order
+    f = is_target[gix] > 0
+    o = np.argsort(tix[f], kind='stable')
+    t, g = tix[f][o], all_genes[gix[f][o]]
+    bounds = np.append(0, np.cumsum(np.bincount(t, minlength=all_terms.size)))
+    gns = np.array([';'.join(g[bounds[i]:bounds[i+1]]) for i in ixt[filt]], dtype='object')
     
     # construct the Pandas DataFrame
-    gns = probs_genes
     enriched_goterms = pd.DataFrame(data=fdr_q_probs,index=enriched_goterms,columns=['fdr_q_value'])
     enriched_goterms['p_value'] = p_values
     enriched_goterms['genes'] = gns
@@ -162,8 +153,239 @@ _KOG_TABLE = dict(A = "RNA processing and modification",
 
 import gc
 from collections.abc import Iterable
+
+class GeneSetIndex(object):
+    def __init__(self, genes, terms, incidence):
+        """Sparse index of gene sets that can be reused across enrichment analyses.
+        
+        Parameters
+        ----------
+        genes - numpy.ndarray
+            Sorted gene IDs (rows of `incidence`).
+            
+        terms - numpy.ndarray
+            Sorted functional annotation terms (columns of `incidence`).
+            
+        incidence - scipy.sparse matrix (genes x terms)
+            Nonzero where a gene is annotated with a term.
+        """
+        self.genes = np.array(genes).astype('str').astype('object')
+        self.terms = np.array(terms).astype('str').astype('object')
+        self.incidence = sp.sparse.csr_matrix(incidence)
+    
+    @classmethod
+    def from_annotations(cls, DFS, col_key, delimiter = '', eggnog_cache = True):
+        """Builds the index from functional annotation tables.
+        
+        Parameters
+        ----------
+        DFS - dictionary of pandas.DataFrame functional annotations keyed by species.
+            Gene IDs in the index are prepended with their species ID. Paths to
+            eggNOG-mapper `.annotations` files are also accepted (see `load_eggnog_annotations`).
+        
+        col_key - str
+            The column name with functional annotations in the annotation DataFrames.
+            
+        delimiter - str, optional, default ''
+            See `FunctionalEnrichment`.
+
+        eggnog_cache - bool or str, optional, default True
+            Caching of parsed eggNOG-mapper files (see `cache` in `load_eggnog_annotations`).
+        """
+        RES = _expand_annotations(_prefixed_annotations(DFS, col_key, cache=eggnog_cache), delimiter)
+        genes, terms, M, _, _ = _gene_set_incidence(q(RES.index), q(RES.values))
+        M.data[:] = 1
+        return cls(genes, terms, M)
+    
+    def restrict(self, genes):
+        """Returns a copy of the index in which gene sets only contain `genes`."""
+        keep = np.in1d(self.genes, genes).astype('float')
+        M = sp.sparse.diags(keep).dot(self.incidence).tocsr()
+        M.eliminate_zeros()
+        return GeneSetIndex(self.genes, self.terms, M)
+    
+    def to_frame(self):
+        """Returns the long-form (gene, term) table with genes as the index and terms in column 'GO'."""
+        x, y = self.incidence.nonzero()
+        return pd.DataFrame(index=self.genes[x], data=self.terms[y], columns=['GO'])
+    
+    def to_dict(self):
+        """Returns the gene sets as a dictionary of gene arrays keyed by term."""
+        M = self.incidence.tocsc()
+        return {t: self.genes[M.indices[M.indptr[i]:M.indptr[i+1]]] for i, t in enumerate(self.terms)}
+    
+    def save(self, path):
+        """Saves the index to a `.npz` file."""
+        M = self.incidence
+        np.savez_compressed(path, genes=self.genes.astype('str'), terms=self.terms.astype('str'),
+                            data=M.data, indices=M.indices, indptr=M.indptr, shape=np.array(M.shape))
+    
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with `save`."""
+        f = np.load(path)
+        M = sp.sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return cls(f['genes'], f['terms'], M)
+
+def _expand_annotations(RES, delimiter):
+    # one row per (gene, annotation) from a Series of delimited annotation strings
+    import re
+    RES = RES[q(RES.values.flatten()).astype('str')!='nan'].astype('str')
+    if delimiter == '':
+        RES = RES.str.findall(r'[^\W\d_]')
+    else:
+        RES = RES.str.split(re.escape(delimiter))
+    return RES.explode().dropna()
+
+_EGGNOG_COLUMNS = ['eggNOG_OGs', 'GOs', 'COG_category']
+
+def load_eggnog_annotations(path, sid, columns = None, cache = True, chunksize = 100000):
+    """Streams an eggNOG-mapper `.annotations` file into a compact table.
+    
+    Only the query column and the requested annotation columns are parsed, and the
+    gene IDs are prepended with the species ID. Missing values ('-') become NaN.
+    
+    Parameters
+    ----------
+    path - str
+        Path to the eggNOG-mapper `.annotations` file.
+        
+    sid - str
+        Species ID to prepend to the gene IDs.
+        
+    columns - list of str, optional, default None
+        The annotation columns to keep. By default, keeps the orthology groups, GO terms
+        and KOG categories ('eggNOG_OGs', 'GOs', 'COG_category').
+        
+    cache - bool or str, optional, default True
+        If True, the parsed table is stored next to `path` (as `{path}.{sid}.samap.npz`) and reused
+        as long as the annotation file is unchanged. Unreadable cache files are ignored. If a str, the table is cached in that directory
+        instead. If False, nothing is cached. If the cache cannot be written (e.g. a read-only
+        directory), the table is returned without caching.
+    
+    chunksize - int, optional, default 100000
+        Number of rows parsed at a time.
+        
+    Returns
+    -------
+    table - pandas.DataFrame with species-prefixed gene IDs as the index.
+    """
+    import os
+    columns = list(_EGGNOG_COLUMNS if columns is None else columns)
+    stat = os.stat(path)
+    cache_path = f'{path}.{sid}.samap.npz'
+    if isinstance(cache, str):
+        cache_path = os.path.join(cache, os.path.basename(cache_path))
+    if cache:
+        cached = _load_annotation_cache(cache_path, stat)
+        if cached is not None:
+            header, table = cached
+            keep = [c for c in columns if c in header]
+            if np.in1d(keep, table.columns).all():
+                return table[keep]
+
+    # skip the '##' comment lines preceding the '#query' header
+    skiprows = 0
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('##'):
+                break
+            skiprows += 1
+        header = line.lstrip('#').rstrip('\n').split('\t')
+    usecols = [header[0]] + [c for c in columns if c in header]
+
+    tables = []
+    reader = pd.read_csv(path, sep='\t', skiprows=skiprows+1, header=None, names=header, usecols=usecols,
+                         dtype='str', na_values='-', keep_default_na=False, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[~chunk[header[0]].str.startswith('#')]
+        chunk.index = sid+'_'+chunk[header[0]].values.astype('object')
+        tables.append(chunk[usecols[1:]])
+    table = pd.concat(tables, axis=0)
+
+    if cache:
+        try:
+            _save_annotation_cache(cache_path, stat, header, table)
+        except OSError as e:
+            warnings.warn(f'Could not cache the eggNOG annotations of {path} ({e}).')
+    return table
+
+def _pack_strings(values):
+    # utf-8 buffer of '\x00'-separated strings and a missing-value mask, storable without pickling
+    values = np.asarray(values, dtype='object')
+    missing = pd.isnull(values)
+    text = '\x00'.join(values[~missing].astype('str'))
+    return np.frombuffer(text.encode(), dtype='uint8'), missing
+
+def _unpack_strings(buf, missing):
+    values = np.array([np.nan] * missing.size, dtype='object')
+    if (~missing).any():
+        values[~missing] = buf.tobytes().decode().split('\x00')
+    return values
+
+def _save_annotation_cache(cache_path, stat, header, table):
+    """Atomically write a parsed annotation table as a data-only `.npz` file."""
+    import os
+    import tempfile
+    arrays = {'stat': np.array([stat.st_mtime, stat.st_size], dtype='float64'),
+              'header': np.array(header, dtype='str'), 'columns': np.array(list(table.columns), dtype='str')}
+    for k, values in enumerate([table.index.values] + [table[c].values for c in table.columns]):
+        arrays[f'buf{k}'], arrays[f'missing{k}'] = _pack_strings(values)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, cache_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _load_annotation_cache(cache_path, stat):
+    """`(header, table)` from an annotation cache file, or None if it is absent, stale or unreadable."""
+    import os
+    import zipfile
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as f:
+            if not np.array_equal(f['stat'], [stat.st_mtime, stat.st_size]):
+                return None
+            columns = f['columns'].tolist()
+            index = _unpack_strings(f['buf0'], f['missing0'])
+            table = pd.DataFrame({c: _unpack_strings(f[f'buf{k+1}'], f[f'missing{k+1}'])
+                                  for k, c in enumerate(columns)}, index=index, columns=columns)
+            return f['header'].tolist(), table
+    except (OSError, ValueError, KeyError, EOFError, UnicodeDecodeError, zipfile.BadZipFile):
+        return None
+
+def _prefixed_annotations(DFS, col_key, cache=True):
+    # one annotation column of every table with species-prefixed gene IDs. tables can
+    # also be paths to eggNOG-mapper `.annotations` files, which are streamed and cached
+    # according to `cache` (see `load_eggnog_annotations`).
+    S = []
+    for k in DFS.keys():
+        if isinstance(DFS[k], str):
+            columns = None if col_key in _EGGNOG_COLUMNS else _EGGNOG_COLUMNS + [col_key]
+            S.append(load_eggnog_annotations(DFS[k], k, columns=columns, cache=cache)[col_key])
+        else:
+            S.append(pd.Series(q(DFS[k][col_key]), index=k+'_'+DFS[k].index))
+    return pd.concat(S, axis=0)
+
+_ENRICHMENT_WORKER = {}
+def _init_enrichment_worker(GENE_SETS, verbose):
+    _ENRICHMENT_WORKER['GENE_SETS'] = GENE_SETS
+    _ENRICHMENT_WORKER['verbose'] = verbose
+
+def _enrichment_worker(job):
+    ii, cln, gi, goterms = job
+    if _ENRICHMENT_WORKER['verbose']:
+        print(f'Calculating functional enrichment for cell type {cln}')
+    return ii, GOEA(gi,_ENRICHMENT_WORKER['GENE_SETS'],goterms=goterms,fdr_thresh=100,p_thresh=100)
+
 class FunctionalEnrichment(object):    
-    def __init__(self,sm, DFS, col_key, keys, delimiter = '', align_thr = 0.1, limit_reference = False, n_top = 0):
+    def __init__(self,sm, DFS, col_key, keys, delimiter = '', align_thr = 0.1, limit_reference = False, n_top = 0,
+                 gene_set_index = None, gene_pairs = None, marker_cache = None, eggnog_cache = True):
         """Performs functional enrichment analysis on gene pairs enriched
         in mapped cell types using functional annotations output by Eggnog.
         
@@ -172,6 +394,7 @@ class FunctionalEnrichment(object):
         sm - SAMAP object.
         
         DFS - dictionary of pandas.DataFrame functional annotations keyed by species present in the input `SAMAP` object.
+            Paths to eggNOG-mapper `.annotations` files are also accepted (see `load_eggnog_annotations`).
         
         col_key - str
             The column name with functional annotations in the annotation DataFrames.
@@ -197,6 +420,23 @@ class FunctionalEnrichment(object):
             Set this to non-zero if you suspect there to be subpopulations of your cell types mapping
             to distinct cell types in the other species.
 
+        gene_set_index: GeneSetIndex or str, optional, default None
+            A prebuilt gene set index (or the path to one saved with `GeneSetIndex.save`). If passed,
+            `DFS`, `col_key` and `delimiter` are ignored and the annotation tables are not parsed again.
+            The index built from `DFS` is stored in `self.gene_set_index` for reuse.
+
+        gene_pairs: pandas.DataFrame, optional, default None
+            Precomputed output of `GenePairFinder.find_all`, in wide or long form. If passed,
+            `keys`, `align_thr` and `n_top` are ignored and gene pairs are not recomputed.
+            Otherwise gene pairs are computed in long form and stored in `self.gene_pairs`.
+
+        marker_cache: str, optional, default None
+            Directory of a persistent cluster marker cache (see `find_cluster_markers`).
+
+        eggnog_cache: bool or str, optional, default True
+            Caching of parsed eggNOG-mapper files passed in `DFS`: True caches next to each file,
+            a str caches in that directory and False disables caching (see `load_eggnog_annotations`).
+
         """
         # get dictionary of sam objects
 
@@ -207,73 +447,32 @@ class FunctionalEnrichment(object):
             sm.sams[sid] = SAMS[sid]
             gc.collect()
             
-        for k in DFS.keys():
-            DFS[k].index = k+'_'+DFS[k].index
-
-        # concatenate DFS
-        A = pd.concat(list(DFS.values()),axis=0)
-        RES = pd.DataFrame(A[col_key])
-        RES.columns=['GO']    
-        RES = RES[(q(RES.values.flatten())!='nan')]
-        
-        # EXPAND RES
-        data = []
-        index = []
-        for i in range(RES.shape[0]):
-            if delimiter == '':
-                l = list(RES.values[i][0])
-                l = np.array([str(x) if str(x).isalpha() else '' for x in l])
-                l = l[l!= '']
-                l = list(l)
-            else:
-                l = RES.values[i][0].split(delimiter)
-                
-            data.extend(l)
-            index.extend([RES.index[i]]*len(l))
-        
-        RES = pd.DataFrame(index = index,data = data,columns = ['GO'])
-        genes = np.array(list(RES.index))
-        agt = np.array(list(RES['GO'].values))
-        idx = np.argsort(agt)
-        genes = genes[idx]
-        agt = agt[idx]
-        bounds = np.where(agt[:-1]!=agt[1:])[0]+1
-        bounds = np.append(np.append(0,bounds),agt.size)
-        bounds_left=bounds[:-1]
-        bounds_right=bounds[1:]
-        genes_lists = [genes[bounds_left[i]:bounds_right[i]] for i in range(bounds_left.size)]
-        GENE_SETS = dict(zip(np.unique(agt),genes_lists)) 
-        for cc in GENE_SETS.keys():
-            GENE_SETS[cc]=np.unique(GENE_SETS[cc])
-        
-        G = []
-        
-        print(f'Finding enriched gene pairs...')
-        gpf = GenePairFinder(sm,keys=keys)
-        gene_pairs = gpf.find_all(thr=align_thr,n_top=n_top)   
-        
-        self.DICT = {}
-        for c in gene_pairs.columns:
-            if "_pval1" not in c and "_pval2" not in c:
-                x = q(gene_pairs[c].values.flatten()).astype('str')
-                ff = x!='nan'
-                if ff.sum()>0:
-                    self.DICT[c] = x[ff]
+        if gene_set_index is None:
+            gene_set_index = GeneSetIndex.from_annotations(DFS, col_key, delimiter = delimiter, eggnog_cache = eggnog_cache)
+        elif isinstance(gene_set_index, str):
+            gene_set_index = GeneSetIndex.load(gene_set_index)
+        RES = gene_set_index.to_frame()
+        
+        if gene_pairs is None:
+            print(f'Finding enriched gene pairs...')
+            gpf = GenePairFinder(sm,keys=keys,marker_cache=marker_cache)
+            gene_pairs = gpf.find_all(thr=align_thr,n_top=n_top,long_form=True)
+        
+        self.DICT = _gene_pair_lists(gene_pairs)
 
         if limit_reference:
             all_genes = np.unique(np.concatenate(substr(np.concatenate(list(self.DICT.values())),';')))
+            GENE_SETS = gene_set_index.restrict(all_genes)
         else:
-            all_genes = np.unique(np.array(list(A.index)))
-        
-        for d in GENE_SETS.keys():
-            GENE_SETS[d] = GENE_SETS[d][np.in1d(GENE_SETS[d],all_genes)]
+            GENE_SETS = gene_set_index
 
         self.gene_pairs = gene_pairs
         self.CAT_NAMES = np.unique(q(RES['GO']))
         self.GENE_SETS = GENE_SETS
+        self.gene_set_index = gene_set_index
         self.RES = RES
         
-    def calculate_enrichment(self,verbose=False):
+    def calculate_enrichment(self,verbose=False,n_jobs=1):
         """ Calculates the functional enrichment.
         
         Parameters
@@ -281,6 +480,9 @@ class FunctionalEnrichment(object):
         verbose - bool, optional, default False
             If False, function does not log progress to output console.
             
+        n_jobs - int, optional, default 1
+            Number of worker processes across which the per-cell-type enrichments are spread.
+            
         Returns
         -------
         ENRICHMENT_SCORES - pandas.DataFrame (cell types x function categories)
@@ -293,55 +495,63 @@ class FunctionalEnrichment(object):
             The IDs of enriched genes for each function in each cell type.
         """
         DICT = self.DICT
-        RES = self.RES
         CAT_NAMES = self.CAT_NAMES
         GENE_SETS = self.GENE_SETS
+        index = self.gene_set_index
         pairs = np.array(list(DICT.keys()))
-        all_nodes = np.unique(np.concatenate(substr(pairs,';')))
-
-        CCG={}
-        P=[]
-        for ik in range(len(all_nodes)):
-            genes=[]
-            nodes = all_nodes[ik]
-            for j in range(len(pairs)):
-                n1,n2 = pairs[j].split(';')
-                if n1 == nodes or n2 == nodes:
-                    g1,g2 = substr(DICT[pairs[j]],';')
-                    genes.append(np.append(g1,g2))
-            if len(genes) > 0:
-                genes = np.concatenate(genes)
-                genes = np.unique(genes)
-            else:
-                genes = np.array([])
-            CCG[all_nodes[ik]] = genes
+        n1, n2 = substr(pairs,';')
+        all_nodes, node_ix = np.unique(np.append(n1,n2), return_inverse=True)
+
+        # integer ids for every gene found in the enriched gene pairs
+        gp = [substr(DICT[p],';') for p in pairs]
+        genes = [np.append(g1,g2) for g1,g2 in gp]
+        all_genes, gene_ix = np.unique(np.concatenate(genes), return_inverse=True)
+        gene_ix = np.split(gene_ix, np.cumsum([x.size for x in genes])[:-1])
+
+        # inverted index of cell type -> cell type pairs
+        node_pairs = np.tile(np.arange(pairs.size), 2)
+        o = np.argsort(node_ix, kind='stable')
+        node_bounds = np.append(0, np.cumsum(np.bincount(node_ix, minlength=all_nodes.size)))
+        node_pairs = node_pairs[o]
+
+        # genes with functional annotations and their categories
+        annotated = np.in1d(all_genes, index.genes)
+        rows = np.zeros(all_genes.size, dtype='int')
+        rows[annotated] = np.searchsorted(index.genes, all_genes[annotated])
+        incidence = index.incidence.tocsr()
+        not_s = index.terms != 'S'
+
+        jobs = []
+        for ii in range(all_nodes.size):
+            ps = node_pairs[node_bounds[ii]:node_bounds[ii+1]]
+            g = np.unique(np.concatenate([gene_ix[j] for j in ps]))
+            g = g[annotated[g]]
+            if g.size > 0:
+                f = np.logical_and(np.asarray(incidence[rows[g]].sum(0)).flatten() > 0, not_s)
+                goterms = index.terms[f]
+                if goterms.size > 0:
+                    jobs.append((ii, all_nodes[ii], all_genes[g], goterms))
 
         HM = np.zeros((len(CAT_NAMES),len(all_nodes)))
         HMe = np.zeros((len(CAT_NAMES),len(all_nodes)))
         HMg = np.zeros((len(CAT_NAMES),len(all_nodes)),dtype='object')
-        for ii,cln in enumerate(all_nodes):
-            if verbose:
-                print(f'Calculating functional enrichment for cell type {cln}')
-                
-            g = CCG[cln]    
-
-            if g.size > 0:
-                gi = g[np.in1d(g,q(RES.index))]
-                ix = np.where(np.in1d(q(RES.index),gi))[0]
-                res = RES.iloc[ix]
-                goterms = np.unique(q(res['GO']))
-                goterms = goterms[goterms!='S'].flatten()
-                if goterms.size > 0:
-                    result = GOEA(gi,GENE_SETS,goterms=goterms,fdr_thresh=100,p_thresh=100)
-
-                    lens = np.array([len(np.unique(x.split(';'))) for x in result['genes'].values])
-                    F = -np.log10(result['p_value'])
-                    gt,vals = F.index,F.values
-                    Z = pd.DataFrame(data=np.arange(CAT_NAMES.size)[None,:],columns=CAT_NAMES)
-                    if gt.size>0:
-                        HM[Z[gt].values.flatten(),ii] = vals
-                        HMe[Z[gt].values.flatten(),ii] = lens
-                        HMg[Z[gt].values.flatten(),ii] = [';'.join(np.unique(x.split(';'))) for x in result['genes'].values]
+        if n_jobs > 1 and len(jobs) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(n_jobs, initializer=_init_enrichment_worker, initargs=(GENE_SETS, verbose)) as pool:
+                results = pool.map(_enrichment_worker, jobs)
+        else:
+            _init_enrichment_worker(GENE_SETS, verbose)
+            results = [_enrichment_worker(job) for job in jobs]
+
+        for ii, result in results:
+            lens = np.array([len(np.unique(x.split(';'))) for x in result['genes'].values])
+            F = -np.log10(result['p_value'])
+            gt,vals = q(F.index),F.values
+            if gt.size>0:
+                z = np.searchsorted(CAT_NAMES, gt)
+                HM[z,ii] = vals
+                HMe[z,ii] = lens
+                HMg[z,ii] = [';'.join(np.unique(x.split(';'))) for x in result['genes'].values]
 
         #CAT_NAMES = [_KOG_TABLE[x] for x in CAT_NAMES]
         SC = pd.DataFrame(data = HM,index=CAT_NAMES,columns=all_nodes).T
@@ -588,8 +798,90 @@ def chord_plot(A,align_thr=0.1):
     return chord
 
 
+def _top_k(a, k):
+    """Indices of the `k` smallest entries of `a`, in the order of a stable argsort."""
+    if k >= a.size:
+        return np.argsort(a, kind='stable')
+    kth = np.partition(a, k - 1)[k - 1]
+    lo = np.flatnonzero(a < kth)
+    ix = np.concatenate((lo, np.flatnonzero(a == kth)[:k - lo.size]))
+    return ix[np.argsort(a[ix], kind='stable')]
+
+def _gene_pairs_path(n1, n2, kwargs, store, fingerprint):
+    import os
+    import hashlib
+    key = repr((str(n1), str(n2), sorted(kwargs.items()), fingerprint))
+    return os.path.join(store, hashlib.md5(key.encode()).hexdigest() + '.pkl')
+
+def _save_gene_pairs(result, n1, n2, kwargs, store, fingerprint):
+    """Write one cell type pair's `find_genes` result to `store`, atomically."""
+    import os
+    import pickle
+    path = _gene_pairs_path(n1, n2, kwargs, store, fingerprint)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump((str(n1), str(n2), result), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+def _load_gene_pairs(n1, n2, kwargs, store, fingerprint):
+    """Read a stored `find_genes` result as `(result, 0.0)`, or None if absent."""
+    import os
+    import pickle
+    path = _gene_pairs_path(n1, n2, kwargs, store, fingerprint)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            a, b, result = pickle.load(f)
+    except Exception:
+        return None
+    if (a, b) != (str(n1), str(n2)) or len(result) != 6:
+        return None
+    return result, 0.0
+
+def _gene_pairs_long_form(res):
+    """Long-form table of `find_genes` results keyed by cell type pair."""
+    names = list(res.keys())
+    ix = np.repeat(np.arange(len(names)), [len(res[k][0]) for k in names])
+    names = np.array(names + [''], dtype='object')[:-1]
+    G = np.concatenate([np.zeros(0, dtype='object')] + [np.asarray(res[k][0], dtype='object') for k in names])
+    ct = substr(names, ';', obj=True) if names.size > 0 else [names, names]
+    gs = substr(G, ';', obj=True) if G.size > 0 else [G, G]
+    def _values(i):
+        return np.concatenate([np.zeros(0)] + [np.asarray(res[k][i], dtype='float64') for k in names])
+    return pd.DataFrame({
+        'cell_type_pair': pd.Categorical(names[ix], categories=names),
+        'cell_type1': pd.Categorical(ct[0][ix]),
+        'cell_type2': pd.Categorical(ct[1][ix]),
+        'gene_pair': pd.Categorical(G),
+        'gene1': pd.Categorical(gs[0]),
+        'gene2': pd.Categorical(gs[1]),
+        'pval1': _values(3),
+        'pval2': _values(4),
+        'score': _values(5),
+    })
+
+def _gene_pair_lists(gene_pairs):
+    """Enriched gene pairs of each cell type pair from a wide or long-form `find_all` table."""
+    D = {}
+    if 'cell_type_pair' in gene_pairs.columns:
+        for c, G in gene_pairs.groupby('cell_type_pair', sort=False, observed=True)['gene_pair']:
+            if G.size > 0:
+                D[str(c)] = q(G).astype('str')
+        return D
+    for c in gene_pairs.columns:
+        if "_pval1" not in c and "_pval2" not in c:
+            x = q(gene_pairs[c].values.flatten()).astype('str')
+            ff = x!='nan'
+            if ff.sum()>0:
+                D[c] = x[ff]
+    return D
+
+_GENE_PAIR_WORKER = {}
+def _find_genes_worker(job):
+    return _GENE_PAIR_WORKER['gpf']._timed_find_genes(*job)
+
 class GenePairFinder(object):
-    def __init__(self, sm, keys=None):
+    def __init__(self, sm, keys=None, marker_cache=None, marker_max_cells=None, marker_n_jobs=1):
         """Find enriched gene pairs in cell type mappings.
         
         sm: SAMAP object
@@ -598,6 +890,16 @@ class GenePairFinder(object):
             Keys corresponding to the annotations vectors in the AnnData's keyed by species ID.
             By default, will use the leiden clusters, e.g. {'hu':'leiden_clusters','ms':'leiden_clusters'}.
 
+        marker_cache: str, optional, default None
+            Directory of a persistent cluster marker cache (see `find_cluster_markers`).
+
+        marker_max_cells: int, optional, default None
+            If set, cluster markers are computed in approximate mode on at most this many cells
+            per cluster (see `find_cluster_markers`).
+
+        marker_n_jobs: int, optional, default 1
+            Number of worker processes used to compute cluster markers (see `find_cluster_markers`).
+
         """
         if keys is None:
             keys={}
@@ -612,20 +914,36 @@ class GenePairFinder(object):
 
         self.ids = sm.ids
         
+        for sid in self.sams.keys():
+            self.sams[sid].adata.obs[keys[sid]] = self.sams[sid].adata.obs[keys[sid]].astype('str')
+
+        self.keys = keys
+        self.update_gene_stats()
+        self._species_blocks = {}
+        self._label_rows = {}
+        self.marker_cache = marker_cache
+        self.marker_max_cells = marker_max_cells
+        self.marker_n_jobs = marker_n_jobs
+        self.find_markers()
+
+    def update_gene_stats(self):
+        """Computes the per-gene means and standard deviations of each species' `X`.
+        
+        They are held in `self.mus` and `self.stds` and reused by every cell type pair.
+        Call this again after modifying the expression matrices.
+        """
         mus={}
         stds={}
         for sid in self.sams.keys():
-            self.sams[sid].adata.obs[keys[sid]] = self.sams[sid].adata.obs[keys[sid]].astype('str')
-            mu, var = sf.mean_variance_axis(self.sams[sid].adata[:, self.gns_dict[sid]].X, axis=0)
+            mu, var = _gene_mean_var(self.sams[sid], self.gns_dict[sid])
             var[var == 0] = 1
             var = var ** 0.5
             mus[sid]=pd.Series(data=mu,index=self.gns_dict[sid])
             stds[sid]=pd.Series(data=var,index=self.gns_dict[sid])
-
         self.mus = mus
         self.stds = stds
-        self.keys = keys
-        self.find_markers()
+        # the homology indices hold gathered means/stds
+        self._homology_indices = {}
 
     def find_markers(self):
         for sid in self.sams.keys():
@@ -636,10 +954,11 @@ class GenePairFinder(object):
             )        
             import gc
             if self.keys[sid]+'_scores' not in self.sams[sid].adata.varm.keys():
-                find_cluster_markers(self.sams[sid], self.keys[sid])
+                find_cluster_markers(self.sams[sid], self.keys[sid], cache=self.marker_cache,
+                                     max_cells=self.marker_max_cells, n_jobs=self.marker_n_jobs)
                 gc.collect()
                     
-    def find_all(self,n=None,align_thr=0.1,n_top=0,**kwargs):
+    def find_all(self,n=None,align_thr=0.1,n_top=0,n_jobs=1,store=None,long_form=False,**kwargs):
         """Find enriched gene pairs in all pairs of mapped cell types.
         
         Parameters
@@ -656,13 +975,36 @@ class GenePairFinder(object):
             Set this to non-zero if you suspect there to be subpopulations of your cell types mapping
             to distinct cell types in the other species.        
             
+        n_jobs: int, optional, default 1
+            Number of worker processes computing cell type pairs concurrently. Workers are forked
+            after the expression matrices, connectivity graph and homology graph are loaded and the
+            homology indices, connectivity blocks and cluster rows of all submitted species pairs are
+            built, so they share this memory instead of receiving copies. Results are identical to
+            the serial path.
+            
+        store: str, optional, default None
+            Directory in which each cell type pair's result is saved as soon as it finishes. Pairs
+            already present in the store are loaded instead of recomputed, so an interrupted run can
+            be resumed and a rerun with a lower `align_thr` only computes the newly included pairs.
+            Stored results are keyed by the `find_genes` arguments, the annotation keys, the marker
+            settings and a fingerprint of the data (expression matrices, labels, SAM weights, marker
+            p-values and the SAMap graphs), so results of a different setup are never reused.
+            
+        long_form: bool, optional, default False
+            If True, returns one row per enriched gene pair instead of the wide table, with
+            categorical columns `cell_type_pair`, `cell_type1`, `cell_type2`, `gene_pair`,
+            `gene1`, `gene2` and float columns `pval1`, `pval2` and `score`. This table can be
+            written directly with `DataFrame.to_parquet`.
+            
         Keyword arguments
         -----------------
         Keyword arguments to `find_genes` accepted here.
         
         Returns
         -------
-        Table of enriched gene pairs for each cell type pair
+        Table of enriched gene pairs for each cell type pair (wide or long form)
+        
+        The time spent on each cell type pair is stored in `self.timings`.
         """        
 
         _,M = get_mapping_scores(self.sm, self.keys, n_top = n_top)
@@ -681,13 +1023,48 @@ class GenePairFinder(object):
         ct1=ct1[f]
         ct2=ct2[f]
         ct1,ct2 = np.unique(np.sort(np.vstack((ct1,ct2)).T,axis=1),axis=0).T
+        fingerprint = self._store_fingerprint() if store is not None else None
+        jobs = [(ct1[i], ct2[i], kwargs, store, fingerprint) for i in range(ct1.size)]
+        results = [None] * len(jobs)
+        if store is not None:
+            import os
+            os.makedirs(store, exist_ok=True)
+            for i, job in enumerate(jobs):
+                results[i] = _load_gene_pairs(*job)
+            n_done = sum(r is not None for r in results)
+            if n_done > 0:
+                print('Loaded {} of {} cell type pairs from {}.'.format(n_done, len(jobs), store))
+        todo = [i for i in range(len(jobs)) if results[i] is None]
+
+        if n_jobs > 1 and len(todo) > 1:
+            import multiprocessing
+            # build the per-species caches before forking so the workers inherit them
+            for i in todo:
+                self._build_caches(*[str(c).split('_')[0] for c in jobs[i][:2]])
+            _GENE_PAIR_WORKER['gpf'] = self
+            try:
+                with multiprocessing.get_context('fork').Pool(n_jobs) as pool:
+                    computed = pool.map(_find_genes_worker, [jobs[i] for i in todo], chunksize=1)
+            finally:
+                _GENE_PAIR_WORKER.clear()
+        else:
+            computed = [self._timed_find_genes(*jobs[i]) for i in todo]
+        for i, r in zip(todo, computed):
+            results[i] = r
+
         res={}
-        for i in range(ct1.size):
-            a = '_'.join(ct1[i].split('_')[1:])
-            b = '_'.join(ct2[i].split('_')[1:])
-            print('Calculating gene pairs for the mapping: {};{} to {};{}'.format(ct1[i].split('_')[0],a,ct2[i].split('_')[0],b))
-            res['{};{}'.format(ct1[i],ct2[i])] = self.find_genes(ct1[i],ct2[i],**kwargs)
+        for (c1, c2, _, _, _), (r, _) in zip(jobs, results):
+            res['{};{}'.format(c1,c2)] = r
+        pair_names = list(res.keys())
+        self.timings = pd.Series(data=[results[i][1] for i in todo],
+                                 index=[pair_names[i] for i in todo], name='seconds', dtype='float')
+        if self.timings.size > 0:
+            print('Computed {} cell type pairs in {:.1f}s (median {:.2f}s, max {:.2f}s for {}).'.format(
+                self.timings.size, self.timings.sum(), self.timings.median(), self.timings.max(), self.timings.idxmax()))
         
+        if long_form:
+            return _gene_pairs_long_form(res)
+
         cols = []
         col_names = []
         for k in res:
@@ -695,10 +1072,41 @@ class GenePairFinder(object):
             col_names.append(k+"_pval1")
             col_names.append(k+"_pval2")
             cols.append(res[k][0])
-            cols.append(res[k][-2])
-            cols.append(res[k][-1])
+            cols.append(res[k][3])
+            cols.append(res[k][4])
         res = pd.DataFrame(cols,index=col_names).fillna(np.nan).T            
         return res
+
+    def _timed_find_genes(self, n1, n2, kwargs, store=None, fingerprint=None):
+        import time
+        a = '_'.join(n1.split('_')[1:])
+        b = '_'.join(n2.split('_')[1:])
+        print('Calculating gene pairs for the mapping: {};{} to {};{}'.format(n1.split('_')[0],a,n2.split('_')[0],b))
+        t = time.time()
+        r = self.find_genes(n1, n2, return_scores=True, **kwargs)
+        t = time.time() - t
+        if store is not None:
+            _save_gene_pairs(r, n1, n2, kwargs, store, fingerprint)
+        return r, t
+
+    def _store_fingerprint(self):
+        """Hash of the annotation keys, marker settings and data that `find_genes` results depend on."""
+        import hashlib
+        h = hashlib.sha1()
+        h.update(repr((sorted(self.keys.items()), self.marker_max_cells)).encode())
+        h.update(_matrix_fingerprint(self.gnnm).encode())
+        h.update(_matrix_fingerprint(self.s3.adata.obsp['connectivities']).encode())
+        h.update('\x00'.join(q(self.s3.adata.obs['species']).astype('str')).encode())
+        for sid in sorted(self.sams.keys()):
+            adata = self.sams[sid].adata
+            pvals = adata.varm[self.keys[sid] + '_pvals']
+            h.update(_matrix_fingerprint(adata.X).encode())
+            h.update('\x00'.join(q(adata.var_names).astype('str')).encode())
+            h.update('\x00'.join(q(adata.obs[self.keys[sid]]).astype('str')).encode())
+            h.update(np.ascontiguousarray(adata.var['weights'].values, dtype='float64').tobytes())
+            h.update('\x00'.join(q(pvals.columns).astype('str')).encode())
+            h.update(np.ascontiguousarray(pvals.values, dtype='float64').tobytes())
+        return h.hexdigest()
         
     def find_genes(
         self,
@@ -708,6 +1116,7 @@ class GenePairFinder(object):
         w2t=0.2,
         n_genes=1000,
         thr=1e-2,
+        return_scores=False,
     ):
         """Find enriched gene pairs in a particular pair of cell types.
         
@@ -726,6 +1135,9 @@ class GenePairFinder(object):
         thr: float, optional, default 0.01
             Excludes genes with greater than 0.01 differential expression p-value.
             
+        return_scores: bool, optional, default False
+            If True, also returns the scores of the enriched gene pairs.
+            
         Returns
         -------
         G - Enriched gene pairs
@@ -733,6 +1145,7 @@ class GenePairFinder(object):
         G2 - Genes from species 2 involved in enriched gene pairs
         pvals1 - pvalues for genes from species 1 involved in enriched gene pairs
         pvals2 - pvalues for genes from species 2 involved in enriched gene pairs
+        scores - scores of the enriched gene pairs (only if `return_scores` is True)
         """
         n1 = str(n1)
         n2 = str(n2)
@@ -747,51 +1160,82 @@ class GenePairFinder(object):
 
         self.gene_pair_scores = pd.Series(index=gpairs, data=m)
 
-        G = q(gpairs[np.argsort(-m)[:n_genes]])
-        G1 = substr(G, ";", 0)
-        G2 = substr(G, ";", 1)
-        pvals1 = q(sam1.adata.varm[self.keys[id1] + "_pvals"][n1][G1])
-        pvals2 = q(sam2.adata.varm[self.keys[id2] + "_pvals"][n2][G2])
+        H = self._homology_index(id1, id2)
+        top = _top_k(-m, n_genes)
+        pvals1 = sam1.adata.varm[self.keys[id1] + "_pvals"][n1].values[H['i1'][top]]
+        pvals2 = sam2.adata.varm[self.keys[id2] + "_pvals"][n2].values[H['i2'][top]]
         filt = np.logical_and(pvals1 < thr,pvals2 < thr)
-        G = q(
-            G[filt]
-        )
-        G1 = substr(G, ";", 0)
-        G2 = substr(G, ";", 1)
-        _, ix1 = np.unique(G1, return_index=True)
-        _, ix2 = np.unique(G2, return_index=True)
-        G1 = G1[np.sort(ix1)]
-        G2 = G2[np.sort(ix2)]
+        top = top[filt]
+        G = q(gpairs[top])
+        _, ix1 = np.unique(H['i1'][top], return_index=True)
+        _, ix2 = np.unique(H['i2'][top], return_index=True)
+        G1 = H['g1'][top][np.sort(ix1)]
+        G2 = H['g2'][top][np.sort(ix2)]
+        if return_scores:
+            return G, G1, G2, pvals1[filt], pvals2[filt], m[top]
         return G, G1, G2, pvals1[filt], pvals2[filt]
 
+    def _homology_index(self, id1, id2):
+        """Integer index of the homology edges from species `id1` to `id2`.
+        
+        Built once per species pair and reused by every cell type pair. Holds the edge
+        endpoints as column positions in each species' AnnData (`i1`, `i2`), their names,
+        the gathered gene means/stds and the binarized SAM weights.
+        """
+        if (id1, id2) not in self._homology_indices:
+            gns = self.gns
+            species = q([x.split('_')[0] for x in gns])
+            e1, e2 = self.gnnm.nonzero()
+            filt = np.logical_and(species[e1] == id1, species[e2] == id2)
+            g1, g2 = gns[e1[filt]], gns[e2[filt]]
+
+            H = {'g1': g1, 'g2': g2, 'gpairs': to_vn(np.array([g1, g2]).T)}
+            for k, sid, g in [('1', id1, g1), ('2', id2, g2)]:
+                adata = self.sams[sid].adata
+                H['i' + k] = adata.var_names.get_indexer(g)
+                H['mu' + k] = self.mus[sid].values[self.mus[sid].index.get_indexer(g)]
+                H['std' + k] = self.stds[sid].values[self.stds[sid].index.get_indexer(g)]
+                w = adata.var["weights"].values[H['i' + k]]
+                H['w' + k] = (w >= 0.2).astype('float')
+            self._homology_indices[(id1, id2)] = H
+        return self._homology_indices[(id1, id2)]
+
+    def _build_caches(self, id1, id2):
+        """Builds the homology index, connectivity blocks and cluster rows of a species pair."""
+        self._homology_index(id1, id2)
+        self._species_block(id1, id2)
+        self._species_block(id2, id1)
+        for sid in [id1, id2]:
+            self._cluster_rows(sid, None)
+
+    def _species_block(self, id1, id2):
+        """CSR block of the SAMap connectivities from species `id1` cells to species `id2` cells."""
+        if (id1, id2) not in self._species_blocks:
+            sp_labels = q(self.s3.adata.obs['species'])
+            self._species_blocks[(id1, id2)] = sp.sparse.csr_matrix(
+                self.s3.adata.obsp["connectivities"][sp_labels == id1, :][:, sp_labels == id2])
+        return self._species_blocks[(id1, id2)]
+
+    def _cluster_rows(self, sid, c):
+        """Row positions of the cells of species `sid` labeled `c`."""
+        if sid not in self._label_rows:
+            x = self.sams[sid].get_labels(self.keys[sid]).astype('str')
+            labels, codes = np.unique(x, return_inverse=True)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.append(0, np.cumsum(np.bincount(codes, minlength=labels.size)))
+            self._label_rows[sid] = {labels[i]: order[bounds[i]:bounds[i + 1]] for i in range(labels.size)}
+        return self._label_rows[sid].get(c, np.zeros(0, dtype='int'))
+
     def _find_link_genes_avg(self, c1, c2, id1, id2, w1t=0.35, w2t=0.35, expr_thr=0.05):
-        mus = self.mus
-        stds = self.stds
         sams=self.sams
-
-        keys=self.keys
-        sam3=self.s3
-        gnnm = self.gnnm
-        gns = self.gns
-        
-        xs = []
-        for sid in [id1,id2]:
-            xs.append(sams[sid].get_labels(keys[sid]).astype('str').astype('object'))
-        x1,x2 = xs
-        g1, g2 = gns[np.vstack(gnnm.nonzero())]
-        gs1,gs2 = q([x.split('_')[0] for x in g1]),q([x.split('_')[0] for x in g2])
-        filt = np.logical_and(gs1==id1,gs2==id2)
-        g1=g1[filt]
-        g2=g2[filt]
+        H = self._homology_index(id1, id2)
+        r1, r2 = self._cluster_rows(id1, c1), self._cluster_rows(id2, c2)
         sam1,sam2 = sams[id1],sams[id2]
-        mu1,std1,mu2,std2 = mus[id1][g1].values,stds[id1][g1].values,mus[id2][g2].values,stds[id2][g2].values
 
-        X1 = _sparse_sub_standardize(sam1.adata[:, g1].X[x1 == c1, :], mu1, std1)
-        X2 = _sparse_sub_standardize(sam2.adata[:, g2].X[x2 == c2, :], mu2, std2)
-        a, b = sam3.adata.obsp["connectivities"][sam3.adata.obs['species']==id1,:][:,sam3.adata.obs['species']==id2][
-            x1 == c1, :][:, x2 == c2].nonzero()
-        c, d = sam3.adata.obsp["connectivities"][sam3.adata.obs['species']==id2,:][:,sam3.adata.obs['species']==id1][
-            x2 == c2, :][:, x1 == c1].nonzero()            
+        X1 = _sparse_sub_standardize(sam1.adata.X[r1, :][:, H['i1']], H['mu1'], H['std1'])
+        X2 = _sparse_sub_standardize(sam2.adata.X[r2, :][:, H['i2']], H['mu2'], H['std2'])
+        a, b = self._species_block(id1, id2)[r1, :][:, r2].nonzero()
+        c, d = self._species_block(id2, id1)[r2, :][:, r1].nonzero()
 
         pairs = np.unique(np.vstack((np.vstack((a, b)).T, np.vstack((d, c)).T)), axis=0)
 
@@ -808,15 +1252,229 @@ class GenePairFinder(object):
             X2.mean(0).A.flatten() > expr_thr
         )
 
-        w1 = sam1.adata.var["weights"][g1].values.copy()
-        w2 = sam2.adata.var["weights"][g2].values.copy()
-        w1[w1 < 0.2] = 0
-        w2[w2 < 0.2] = 0
-        w1[w1 > 0] = 1
-        w2[w2 > 0] = 1
-        return val * w1 * w2 * min_expr, to_vn(np.array([g1,g2]).T)
+        return val * H['w1'] * H['w2'] * min_expr, H['gpairs']
+
+_MARKER_WORKER = {}
+def _init_marker_worker(X, codes, n_groups):
+    _MARKER_WORKER['X'] = X
+    _MARKER_WORKER['codes'] = codes
+    _MARKER_WORKER['n_groups'] = n_groups
+
+def _marker_worker(bounds):
+    return _wilcoxon_rank_sums(_MARKER_WORKER['X'][:, bounds[0]:bounds[1]],
+                               _MARKER_WORKER['codes'], _MARKER_WORKER['n_groups'])
+
+def _wilcoxon_rank_sums(X, codes, n_groups):
+    """Per-group sums of the within-gene ranks of the cells in a CSC matrix.
+    
+    Ranks are those of `rankdata(..., method='average')` over each full column, but are
+    computed from the stored entries only: all implicit zeros of a gene share a single rank,
+    so the cost scales with the number of nonzeros rather than cells x genes.
+    
+    Parameters
+    ----------
+    X - scipy.sparse.csc_matrix (cells x genes)
+    
+    codes - numpy.ndarray of int
+        Group of each cell, from 0 to `n_groups - 1`.
+        
+    n_groups - int
+    
+    Returns
+    -------
+    R - numpy.ndarray (groups x genes) of rank sums
+    """
+    n_cells, n_genes = X.shape
+    nnz = np.diff(X.indptr)
+    col = np.repeat(np.arange(n_genes), nnz)
+    vals = X.data
+    order = np.lexsort((vals, col))
+    sv, sc_ = vals[order], col[order]
+    
+    # ties within a gene among the stored entries
+    start = np.ones(sv.size, dtype='bool')
+    start[1:] = (sv[1:] != sv[:-1]) | (sc_[1:] != sc_[:-1])
+    tie = np.cumsum(start) - 1
+    tie_start = np.flatnonzero(start)
+    tie_size = np.diff(np.append(tie_start, sv.size))
+    less = (tie_start - X.indptr[:-1][sc_[tie_start]])[tie]
+    equal = tie_size[tie].astype('float')
+    
+    # implicit zeros of each gene
+    zeros = n_cells - nnz
+    less = less + zeros[sc_] * (sv > 0)
+    equal = equal + zeros[sc_] * (sv == 0)
+    ranks = np.zeros(sv.size)
+    ranks[order] = less + (equal + 1) / 2
+    
+    neg = np.bincount(col[vals < 0], minlength=n_genes)
+    zero_rank = neg + (zeros + np.bincount(col[vals == 0], minlength=n_genes) + 1) / 2
+    
+    R = np.bincount(codes[X.indices] * n_genes + col, weights=ranks - zero_rank[col],
+                    minlength=n_groups * n_genes).reshape((n_groups, n_genes))
+    counts = np.bincount(codes, minlength=n_groups)
+    return R + counts[:, None] * zero_rank[None, :]
 
-def find_cluster_markers(sam, key, inplace=True):
+def _wilcoxon_markers(X, codes, n_groups, n_jobs=1, chunk_nnz=5000000):
+    """One-vs-rest Wilcoxon rank-sum scores and p-values for every group of `labels`.
+    
+    Matches `scanpy.tl.rank_genes_groups(method='wilcoxon')` without tie correction.
+    
+    Parameters
+    ----------
+    X - scipy.sparse matrix or numpy.ndarray (cells x genes)
+    
+    codes - numpy.ndarray of int
+        Group of each cell, from 0 to `n_groups - 1`.
+        
+    n_groups - int
+    
+    n_jobs - int, optional, default 1
+        Number of worker processes to spread gene blocks across.
+        
+    chunk_nnz - int, optional, default 5000000
+        Approximate maximum number of nonzero entries per gene block. With `n_jobs > 1`,
+        blocks are capped at `X.nnz / n_jobs` so that every worker receives one.
+        
+    Returns
+    -------
+    scores, pvals - numpy.ndarray (genes x groups)
+    """
+    from scipy.stats import norm
+    X = sp.sparse.csc_matrix(X)
+    n_cells, n_genes = X.shape
+    if n_jobs > 1:
+        chunk_nnz = max(1, min(chunk_nnz, -(-X.nnz // n_jobs)))
+    
+    edges = np.searchsorted(X.indptr, np.arange(chunk_nnz, X.nnz, chunk_nnz))
+    edges = np.unique(np.concatenate(([0], edges, [n_genes])))
+    bounds = list(zip(edges[:-1], edges[1:]))
+    
+    if n_jobs > 1 and len(bounds) > 1:
+        import multiprocessing
+        with multiprocessing.get_context('fork').Pool(
+                n_jobs, initializer=_init_marker_worker, initargs=(X, codes, n_groups)) as pool:
+            R = pool.map(_marker_worker, bounds, chunksize=1)
+    else:
+        R = [_wilcoxon_rank_sums(X[:, l:r], codes, n_groups) for l, r in bounds]
+    R = np.hstack(R) if len(R) > 0 else np.zeros((n_groups, 0))
+    
+    n_active = np.bincount(codes, minlength=n_groups)[:, None]
+    std_dev = np.sqrt(n_active * (n_cells - n_active) * (n_cells + 1) / 12.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (R - n_active * (n_cells + 1) / 2.0) / std_dev
+    scores[np.isnan(scores)] = 0
+    pvals = 2 * norm.sf(np.abs(scores))
+    return scores.T, pvals.T
+
+def _benjamini_hochberg(pvals):
+    # same arithmetic as statsmodels' multipletests(method='fdr_bh'), used by scanpy
+    order = np.argsort(pvals)
+    n = pvals.size
+    adj = np.minimum.accumulate((pvals[order] / (np.arange(1, n + 1) / float(n)))[::-1])[::-1]
+    adj[adj > 1] = 1
+    out = np.empty(n)
+    out[order] = adj
+    return out
+
+def _rank_genes_groups_uns(adata, key, X, codes, groups, scores, pvals):
+    """Results in the layout of `adata.uns['rank_genes_groups']` as written by scanpy's Wilcoxon test.
+    
+    Genes are ordered per group as scanpy orders them. Log fold changes are computed from
+    the group and rest means of `X` (the cells that were tested, labeled by `codes`).
+    """
+    n_cells, n_genes = X.shape
+    onehot = sp.sparse.coo_matrix((np.ones(codes.size), (codes, np.arange(codes.size))),
+                                  shape=(groups.size, n_cells)).tocsr()
+    sums = onehot.dot(X)
+    sums = sums.toarray() if sp.sparse.issparse(sums) else np.asarray(sums)
+    n = np.bincount(codes, minlength=groups.size)[:, None]
+    means = sums / n
+    means_rest = (sums.sum(0)[None, :] - sums) / (n_cells - n)
+    base = adata.uns['log1p'].get('base') if 'log1p' in adata.uns.keys() else None
+    expm1 = np.expm1 if base is None else (lambda x: np.expm1(x * np.log(base)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lfc = np.log2((expm1(means) + 1e-9) / (expm1(means_rest) + 1e-9))
+
+    gn = q(adata.var_names).astype('object')
+    stats = {c: {} for c in ['names', 'scores', 'pvals', 'pvals_adj', 'logfoldchanges']}
+    for i, g in enumerate(groups):
+        s = scores[:, i]
+        part = np.argpartition(s, -n_genes)[-n_genes:]
+        ix = part[np.argsort(s[part])[::-1]]
+        p = pvals[:, i].copy()
+        p[np.isnan(p)] = 1
+        g = str(g)
+        stats['names'][g] = gn[ix]
+        stats['scores'][g] = s[ix]
+        stats['pvals'][g] = pvals[ix, i]
+        stats['pvals_adj'][g] = _benjamini_hochberg(p)[ix]
+        stats['logfoldchanges'][g] = lfc[i, ix]
+    dtypes = {'names': 'O', 'scores': 'float32', 'logfoldchanges': 'float32', 'pvals': 'float64',
+              'pvals_adj': 'float64'}
+    uns = {'params': dict(groupby=key, reference='rest', method='wilcoxon', use_raw=False, layer=None,
+                          corr_method='benjamini-hochberg')}
+    for c in stats:
+        uns[c] = pd.DataFrame(stats[c], columns=[str(g) for g in groups]).to_records(
+            index=False, column_dtypes=dtypes[c])
+    return uns
+
+def _marker_groups(labels):
+    """Groups of `labels` as strings, in the order `rank_genes_groups` reports them."""
+    if hasattr(labels, 'cat'):
+        present = set(q(labels))
+        return np.array([str(c) for c in labels.cat.categories if c in present], dtype='object')
+    from natsort import natsorted
+    return np.array(natsorted(np.unique(q(labels).astype('str'))), dtype='object')
+
+def _marker_fingerprint(sam, key, method):
+    """Hash of the expression matrix, the labels and the marker test parameters."""
+    import hashlib
+    h = hashlib.sha1()
+    X = sam.adata.X
+    h.update(repr((X.shape, str(X.dtype), method, 'wilcoxon', 'rest', 'no_tie_correct')).encode())
+    if sp.sparse.issparse(X):
+        X = sp.sparse.csr_matrix(X)
+        for arr in (X.indptr, X.indices, X.data):
+            h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        h.update(np.ascontiguousarray(X).tobytes())
+    h.update('\x00'.join(q(sam.adata.obs[key]).astype('str')).encode())
+    h.update('\x00'.join(q(sam.adata.var_names).astype('str')).encode())
+    return h.hexdigest()
+
+def _subsample_clusters(labels, keep, max_cells, seed=0):
+    """Mask of at most `max_cells` randomly chosen cells per cluster among the `keep` cells."""
+    rng = np.random.default_rng(seed)
+    ix = rng.permutation(np.flatnonzero(keep))
+    _, codes = np.unique(labels[ix].astype('str'), return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    ix, codes = ix[order], codes[order]
+    rank = np.arange(ix.size) - np.searchsorted(codes, codes)
+    sub = np.zeros(labels.size, dtype='bool')
+    sub[ix[rank < max_cells]] = True
+    return sub
+
+def _marker_agreement(sam, keep, codes, n_groups, scores, pvals, n_check=500, thr=1e-2, seed=0):
+    """Compares approximate marker results against the exact test on held-out genes.
+    
+    The exact test is run on all `keep` cells for a random sample of `n_check` genes.
+    Returns the rank correlation of the scores and the fraction of (gene, cluster)
+    entries on which both modes agree that p < `thr`.
+    """
+    rng = np.random.default_rng(seed + 1)
+    genes = np.sort(rng.choice(scores.shape[0], min(n_check, scores.shape[0]), replace=False))
+    X = sam.adata.X[:, genes]
+    X = X[keep] if not keep.all() else X
+    es, ep = _wilcoxon_markers(X, codes, n_groups)
+    a, b = rankdata(es.flatten()), rankdata(scores[genes].flatten())
+    corr = float(np.corrcoef(a, b)[0, 1]) if a.size > 1 and a.std() > 0 and b.std() > 0 else 1.0
+    agree = float(((ep < thr) == (pvals[genes] < thr)).mean())
+    return {'n_check_genes': int(genes.size), 'score_rank_corr': corr, 'pval_thr': thr,
+            'call_agreement': agree}
+
+def find_cluster_markers(sam, key, inplace=True, method='sparse', n_jobs=1, cache=None,
+                         max_cells=None, seed=0):
     """ Finds differentially expressed genes for provided cell type labels.
     
     Parameters
@@ -834,14 +1492,108 @@ def find_cluster_markers(sam, key, inplace=True):
             NAMES - the gene names
             PVALS - the p-values
             SCORES - the enrichment scores
+            
+    method - str, optional, default 'sparse'
+        'sparse' ranks genes directly on the sparse expression matrix in gene blocks, without
+        copying the AnnData. 'scanpy' runs `scanpy.tl.rank_genes_groups` on a copy. Both compute
+        the same one-vs-rest Wilcoxon test and write `sam.adata.uns['rank_genes_groups']` (except
+        when results are loaded from `cache`).
+        
+    n_jobs - int, optional, default 1
+        Number of worker processes for the 'sparse' method.
+        
+    cache - str, optional, default None
+        Directory of a persistent marker cache. Results are stored under a hash of `key` and a
+        fingerprint of the expression matrix, the labels in `key` and the test parameters, and
+        loaded from there by later calls (from any process) instead of being recomputed. Entries
+        are written atomically; unreadable entries are recomputed. Only used if `inplace`.
+        
+    max_cells - int, optional, default None
+        If set, ranks genes on a random subsample of at most `max_cells` cells per cluster
+        (approximate mode). The results are checked against the exact test on a held-out sample
+        of genes, and the agreement is printed and stored in `sam.adata.uns[f'{key}_markers_check']`.
+        
+    seed - int, optional, default 0
+        Random seed for the subsample in approximate mode.
     """
+    if cache is not None and inplace:
+        import os
+        params = method if max_cells is None else (method, int(max_cells), seed)
+        import hashlib
+        import tempfile
+        import zipfile
+        params = method if max_cells is None else (method, int(max_cells), seed)
+        name = hashlib.sha1(repr((str(key), _marker_fingerprint(sam, key, params))).encode()).hexdigest()
+        path = os.path.join(cache, name + '.npz')
+        cached = None
+        if os.path.exists(path):
+            # unreadable entries (e.g. truncated) are recomputed and overwritten
+            try:
+                with np.load(path, allow_pickle=False) as f:
+                    cached = f['scores'], f['pvals'], f['groups'], f['singletons']
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                cached = None
+        if cached is not None:
+            _store_markers(sam, key, *cached)
+            return
+        find_cluster_markers(sam, key, method=method, n_jobs=n_jobs, max_cells=max_cells, seed=seed)
+        # the stored tables already include the singleton columns
+        columns = q(sam.adata.varm[key+'_scores'].columns).astype('str')
+        try:
+            os.makedirs(cache, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, scores=sam.adata.varm[key+'_scores'].values, pvals=sam.adata.varm[key+'_pvals'].values,
+                             groups=columns, singletons=np.zeros(0, dtype=columns.dtype))
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        except OSError as e:
+            warnings.warn(f'Could not write the marker cache {path} ({e}).')
+        return
+        
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")   
         
         a,c = np.unique(q(sam.adata.obs[key]),return_counts=True)
         t = a[c==1]
-
-        adata = sam.adata[np.in1d(q(sam.adata.obs[key]),a[c==1],invert=True)].copy()
+        labels = sam.adata.obs[key]
+        keep = np.in1d(q(labels), t, invert=True)
+        sub = keep if max_cells is None else _subsample_clusters(q(labels), keep, max(max_cells, 2), seed)
+
+        def _check(scores, pvals, groups):
+            if max_cells is None:
+                return
+            codes = pd.Categorical(q(labels[keep]).astype('str'), categories=groups).codes.astype('int')
+            report = _marker_agreement(sam, keep, codes, len(groups), scores, pvals, seed=seed)
+            report.update({'max_cells': int(max_cells), 'seed': seed, 'n_cells': int(keep.sum()),
+                           'n_cells_used': int(sub.sum())})
+            sam.adata.uns[key + '_markers_check'] = report
+            print('Approximate markers for {}: {} of {} cells, score rank correlation {:.3f}, '
+                  'p<{} agreement {:.3f} on {} held-out genes.'.format(
+                      key, report['n_cells_used'], report['n_cells'], report['score_rank_corr'],
+                      report['pval_thr'], report['call_agreement'], report['n_check_genes']))
+
+        if method == 'sparse':
+            groups = _marker_groups(labels[keep])
+            codes = pd.Categorical(q(labels[sub]).astype('str'), categories=groups).codes
+            X = sam.adata.X if sub.all() else sam.adata.X[sub]
+            scores, pvals = _wilcoxon_markers(X, codes.astype('int'), groups.size, n_jobs=n_jobs)
+            _check(scores, pvals, groups)
+            sam.adata.uns['rank_genes_groups'] = _rank_genes_groups_uns(
+                sam.adata, key, X, codes.astype('int'), groups, scores, pvals)
+            if not inplace:
+                NAMES = pd.DataFrame(sam.adata.uns["rank_genes_groups"]["names"])
+                PVALS = pd.DataFrame(sam.adata.uns["rank_genes_groups"]["pvals"])
+                SCORES = pd.DataFrame(sam.adata.uns["rank_genes_groups"]["scores"])
+                return NAMES, PVALS, SCORES
+            _store_markers(sam, key, scores.astype('float32'), pvals, groups, t)
+            return
+
+        adata = sam.adata[sub].copy()
         sc.tl.rank_genes_groups(
             adata,
             key,
@@ -858,39 +1610,41 @@ def find_cluster_markers(sam, key, inplace=True):
         SCORES = pd.DataFrame(sam.adata.uns["rank_genes_groups"]["scores"])
         if not inplace:
             return NAMES, PVALS, SCORES
-        dfs1 = []
-        dfs2 = []
-        for i in range(SCORES.shape[1]):
-            names = NAMES.iloc[:, i]
-            scores = SCORES.iloc[:, i]
-            pvals = PVALS.iloc[:, i]
-            pvals[scores < 0] = 1.0
-            scores[scores < 0] = 0
-            pvals = q(pvals)
-            scores = q(scores)
-
-            dfs1.append(pd.DataFrame(
-                data=scores[None, :], index = [SCORES.columns[i]], columns=names
-            )[sam.adata.var_names].T)
-            dfs2.append(pd.DataFrame(
-                data=pvals[None, :], index = [SCORES.columns[i]], columns=names
-            )[sam.adata.var_names].T)
-        df1 = pd.concat(dfs1,axis=1)
-        df2 = pd.concat(dfs2,axis=1)
-
-        try:
-            sam.adata.varm[key+'_scores'] = df1
-            sam.adata.varm[key+'_pvals'] = df2
-        except:
-            sam.adata.varm.dim_names = sam.adata.var_names
-            sam.adata.varm.dim_names = sam.adata.var_names
-            sam.adata.varm[key+'_scores'] = df1
-            sam.adata.varm[key+'_pvals'] = df2        
-
-        for i in range(t.size):
-            sam.adata.varm[key+'_scores'][t[i]]=0
-            sam.adata.varm[key+'_pvals'][t[i]]=1
 
+        # scatter each cluster's ranked genes back to their positions in var_names
+        gn = q(sam.adata.var_names)
+        order = np.argsort(gn)
+        rows = order[np.searchsorted(gn[order], NAMES.values.astype('str'))]
+        cols = np.broadcast_to(np.arange(NAMES.shape[1])[None, :], rows.shape)
+        scores = np.zeros((gn.size, NAMES.shape[1]), dtype=SCORES.values.dtype)
+        pvals = np.ones((gn.size, NAMES.shape[1]), dtype=PVALS.values.dtype)
+        scores[rows, cols] = SCORES.values
+        pvals[rows, cols] = PVALS.values
+        _check(scores, pvals, q(SCORES.columns))
+        _store_markers(sam, key, scores, pvals, SCORES.columns, t)
+
+
+def _store_markers(sam, key, scores, pvals, groups, singletons):
+    """Writes genes x clusters marker scores and p-values to `sam.adata.varm`.
+    
+    Negative scores are set to 0 (p-value 1) and singleton clusters, which are not
+    tested, are appended as columns of 0 scores and p-values of 1.
+    """
+    pvals[scores < 0] = 1.0
+    scores[scores < 0] = 0
+    n = scores.shape[0]
+    scores = np.hstack((scores, np.zeros((n, singletons.size), dtype=scores.dtype)))
+    pvals = np.hstack((pvals, np.ones((n, singletons.size), dtype=pvals.dtype)))
+    columns = list(groups) + list(singletons)
+    df1 = pd.DataFrame(scores, index=sam.adata.var_names, columns=columns)
+    df2 = pd.DataFrame(pvals, index=sam.adata.var_names, columns=columns)
+    try:
+        sam.adata.varm[key+'_scores'] = df1
+        sam.adata.varm[key+'_pvals'] = df2
+    except:
+        sam.adata.varm.dim_names = sam.adata.var_names
+        sam.adata.varm[key+'_scores'] = df1
+        sam.adata.varm[key+'_pvals'] = df2
 
 
 def ParalogSubstitutions(sm, ortholog_pairs, paralog_pairs=None, psub_thr = 0.3):
@@ -924,136 +1678,124 @@ def ParalogSubstitutions(sm, ortholog_pairs, paralog_pairs=None, psub_thr = 0.3)
         
     """
     if paralog_pairs is not None:
-        ids1 = np.array([x.split('_')[0] for x in paralog_pairs[:,0]])
-        ids2 = np.array([x.split('_')[0] for x in paralog_pairs[:,1]])
+        ortholog_pairs = np.asarray(ortholog_pairs)
+        paralog_pairs = np.asarray(paralog_pairs)
+        ids1 = substr(paralog_pairs[:,0], '_', 0) if paralog_pairs.shape[0] > 0 else np.zeros(0)
+        ids2 = substr(paralog_pairs[:,1], '_', 0) if paralog_pairs.shape[0] > 0 else np.zeros(0)
         ix = np.where(ids1==ids2)[0]
         ixnot = np.where(ids1!=ids2)[0]
         
         if ix.size > 0:
-            pps = paralog_pairs[ix]
-            
-            ZZ1 = {}
-            ZZ2 = {}
-            for i in range(pps.shape[0]):    
-                L = ZZ1.get(pps[i,0],[])
-                L.append(pps[i,1])
-                ZZ1[pps[i,0]]=L
-
-                L = ZZ2.get(pps[i,1],[])
-                L.append(pps[i,0])
-                ZZ2[pps[i,1]]=L      
-
-            keys = list(ZZ1.keys())
-            for k in keys:
-                L = ZZ2.get(k,[])
-                L.extend(ZZ1[k])
-                ZZ2[k] = list(np.unique(L))
-
-            ZZ = ZZ2
-
-            L1=[]
-            L2=[]
-            for i in range(ortholog_pairs.shape[0]):
-                try:
-                    x = ZZ[ortholog_pairs[i,0]]
-                except:
-                    x = []
-                L1.extend([ortholog_pairs[i,1]]*len(x))
-                L2.extend(x)
-
-                try:
-                    x = ZZ[ortholog_pairs[i,1]]
-                except:
-                    x = []
-                L1.extend([ortholog_pairs[i,0]]*len(x))
-                L2.extend(x)        
-
-            L = np.vstack((L2,L1)).T
-            pps = np.unique(np.sort(L,axis=1),axis=0)
+            # within-species paralogs of one ortholog are paralogs of the other: P @ O
+            names, ids = np.unique(np.concatenate((paralog_pairs.flatten(), ortholog_pairs.flatten())),
+                                   return_inverse=True)
+            pp = ids[:paralog_pairs.size].reshape((-1, 2))
+            op = ids[paralog_pairs.size:].reshape((-1, 2))
+            P = _adjacency(pp[ix, 0], pp[ix, 1], names.size)
+            O = _adjacency(op[:, 0], op[:, 1], names.size)
+            x, y = (P @ O).nonzero()
             
-            paralog_pairs = np.unique(np.sort(np.vstack((pps,paralog_pairs[ixnot])),axis=1),axis=0)
+            paralog_pairs = names[np.unique(np.sort(np.vstack((np.vstack((x, y)).T, pp[ixnot])), axis=1), axis=0)]
         
         
     smp = sm.samap
     
     gnnm = smp.adata.varp["homology_graph_reweighted"]
     gn = q(smp.adata.var_names)
+    gix = pd.Index(gn)
+    species = np.unique(substr(gn, '_', 0), return_inverse=True)[1]
     
-    ortholog_pairs = np.sort(ortholog_pairs,axis=1)
-
-    ortholog_pairs = ortholog_pairs[np.logical_and(np.in1d(ortholog_pairs[:,0],gn),np.in1d(ortholog_pairs[:,1],gn))]
+    op = gix.get_indexer(np.asarray(ortholog_pairs).flatten()).reshape((-1, 2))
+    op = np.sort(op[(op >= 0).all(1)], axis=1)
     if paralog_pairs is None:
-        paralog_pairs = gn[np.vstack(smp.adata.varp["homology_graph"].nonzero()).T]
+        pp = np.vstack(smp.adata.varp["homology_graph"].nonzero()).T
     else:
-        paralog_pairs = paralog_pairs[np.logical_and(np.in1d(paralog_pairs[:,0],gn),np.in1d(paralog_pairs[:,1],gn))]
-        
-    paralog_pairs = np.sort(paralog_pairs,axis=1)        
-
-    paralog_pairs = paralog_pairs[
-        np.in1d(to_vn(paralog_pairs), np.append(to_vn(ortholog_pairs),to_vn(ortholog_pairs[:,::-1])), invert=True)
-    ]
-
-    A = pd.DataFrame(data=np.arange(gn.size)[None, :], columns=gn)
-    xp, yp = (
-        A[paralog_pairs[:, 0]].values.flatten(),
-        A[paralog_pairs[:, 1]].values.flatten(),
-    )
-    xp, yp = np.unique(
-        np.vstack((np.vstack((xp, yp)).T, np.vstack((yp, xp)).T)), axis=0
-    ).T
-
-    xo, yo = (
-        A[ortholog_pairs[:, 0]].values.flatten(),
-        A[ortholog_pairs[:, 1]].values.flatten(),
-    )
-    xo, yo = np.unique(
-        np.vstack((np.vstack((xo, yo)).T, np.vstack((yo, xo)).T)), axis=0
-    ).T
-    A = pd.DataFrame(data=np.vstack((xp, yp)).T, columns=["x", "y"])
-    pairdict = df_to_dict(A, key_key="x", val_key="y")
-    Xp = []
-    Yp = []
-    Xo = []
-    Yo = []
-    for i in range(xo.size):
-        try:
-            y = pairdict[xo[i]]
-        except KeyError:
-            y = np.array([])
-        Yp.extend(y)
-        Xp.extend([xo[i]] * y.size)
-        Xo.extend([xo[i]] * y.size)
-        Yo.extend([yo[i]] * y.size)
-
-    orths = to_vn(gn[np.vstack((np.array(Xo), np.array(Yo))).T])
-    paras = to_vn(gn[np.vstack((np.array(Xp), np.array(Yp))).T])
-    orth_corrs = gnnm[Xo, Yo].A.flatten()
-    par_corrs = gnnm[Xp, Yp].A.flatten()
+        pp = gix.get_indexer(np.asarray(paralog_pairs).flatten()).reshape((-1, 2))
+        pp = pp[(pp >= 0).all(1)]
+    pp = np.sort(pp, axis=1)
+    pp = pp[np.in1d(pp[:, 0] * gn.size + pp[:, 1], op[:, 0] * gn.size + op[:, 1], invert=True)]
+    
+    # every ortholog edge (a, b) combined with every paralog edge (a, c) sharing its first gene
+    O = _adjacency(op[:, 0], op[:, 1], gn.size)
+    P = _adjacency(pp[:, 0], pp[:, 1], gn.size)
+    Xo = np.repeat(np.arange(gn.size), np.diff(O.indptr))
+    Yo = O.indices
+    k = np.diff(P.indptr)[Xo]
+    start = np.repeat(P.indptr[Xo] - (np.cumsum(k) - k), k)
+    Yp = P.indices[start + np.arange(k.sum())]
+    Xo = np.repeat(Xo, k)
+    Yo = np.repeat(Yo, k)
+
+    orth_corrs = np.asarray(gnnm[Xo, Yo]).flatten()
+    par_corrs = np.asarray(gnnm[Xo, Yp]).flatten()
     diff_corrs = par_corrs - orth_corrs
+    
+    # keep substitutions whose paralog pair spans the species of the ortholog pair
+    filt = np.logical_and(diff_corrs > psub_thr, np.logical_or(
+        species[Yo] == species[Xo], species[Yo] == species[Yp]))
+    ix = np.flatnonzero(filt)
+    ix = ix[np.argsort(-diff_corrs[ix], kind='stable')]
 
     RES = pd.DataFrame(
-        data=np.vstack((orths, paras)).T, columns=["ortholog pairs", "paralog pairs"]
+        data=np.vstack((to_vn(gn[np.vstack((Xo[ix], Yo[ix])).T]) if ix.size > 0 else np.zeros(0, dtype='object'),
+                        to_vn(gn[np.vstack((Xo[ix], Yp[ix])).T]) if ix.size > 0 else np.zeros(0, dtype='object'))).T,
+        columns=["ortholog pairs", "paralog pairs"], index=ix
     )
-    RES["ortholog corrs"] = orth_corrs
-    RES["paralog corrs"] = par_corrs
-    RES["corr diff"] = diff_corrs
-    RES = RES.sort_values("corr diff", ascending=False)
-    RES = RES[RES["corr diff"] > psub_thr]
-    orths = RES['ortholog pairs'].values.flatten()
-    paras = RES['paralog pairs'].values.flatten()
-    if orths.size > 0:
-        orthssp = np.vstack([np.array([x.split('_')[0] for x in xx]) for xx in to_vo(orths)])
-        parassp = np.vstack([np.array([x.split('_')[0] for x in xx]) for xx in to_vo(paras)])
-        filt=[]
-        for i in range(orthssp.shape[0]):
-            filt.append(np.in1d(orthssp[i],parassp[i]).mean()==1.0)
-        filt=np.array(filt)
-        return RES[filt]
-    else:
-        return RES
-
-
-def convert_eggnog_to_homologs(sm, EGGs, og_key = 'eggNOG_OGs', taxon=2759):
+    RES["ortholog corrs"] = orth_corrs[ix]
+    RES["paralog corrs"] = par_corrs[ix]
+    RES["corr diff"] = diff_corrs[ix]
+    return RES
+
+def _adjacency(x, y, n):
+    """Binary symmetric CSR adjacency matrix of the edges (x, y) among n nodes."""
+    A = sp.sparse.coo_matrix((np.ones(2 * x.size), (np.append(x, y), np.append(y, x))), shape=(n, n)).tocsr()
+    A.sum_duplicates()
+    A.sort_indices()
+    A.data[:] = 1
+    return A
+
+
+def _grouped_pairs(groups, species=None, chunk_size=1000000):
+    """Yields the pairs of items sharing a group (e.g. genes in an orthogroup), in chunks.
+    
+    Parameters
+    ----------
+    groups - numpy.ndarray of int
+        Group code of each item (-1 for none).
+        
+    species - numpy.ndarray of int, optional, default None
+        If passed, only pairs of items with different codes (e.g. species) are emitted.
+        
+    chunk_size - int, optional, default 1000000
+        Approximate number of candidate pairs per chunk. Memory stays bounded by this
+        (or by the size of the largest group) rather than by the total number of pairs.
+        
+    Yields
+    ------
+    i, j - numpy.ndarray of item indices, each unordered pair emitted once. Within a
+        group, `i` precedes `j` in the (stable) order of the items.
+    """
+    order = np.argsort(groups, kind='stable')
+    order = order[groups[order] >= 0]
+    g = groups[order]
+    # member k of a group pairs with the members after it in the same group
+    counts = np.searchsorted(g, g, side='right') - np.arange(g.size) - 1
+    cum = np.cumsum(counts)
+    lo = 0
+    while lo < g.size:
+        hi = max(np.searchsorted(cum, cum[lo] - counts[lo] + chunk_size, side='right'), lo + 1)
+        c = counts[lo:hi]
+        a = np.repeat(np.arange(lo, hi), c)
+        b = a + 1 + np.arange(a.size) - np.repeat(np.cumsum(c) - c, c)
+        i, j = order[a], order[b]
+        if species is not None:
+            keep = species[i] != species[j]
+            i, j = i[keep], j[keep]
+        yield i, j
+        lo = hi
+
+def convert_eggnog_to_homologs(sm, EGGs, og_key = 'eggNOG_OGs', taxon=2759, path=None, chunk_size=1000000,
+                               eggnog_cache=True):
     """Gets an n x 2 array of homologs at some taxonomic level based on Eggnog results.
     
     Parameters
@@ -1061,6 +1803,7 @@ def convert_eggnog_to_homologs(sm, EGGs, og_key = 'eggNOG_OGs', taxon=2759):
     smp: SAMAP object
     
     EGGs: dict of pandas.DataFrame, Eggnog output tables keyed by species IDs
+        Paths to eggNOG-mapper `.annotations` files are also accepted (see `load_eggnog_annotations`).
 
     og_key: str, optional, default 'eggNOG_OGs'
         The column name of the orthology group mapping results in the Eggnog output tables.
@@ -1069,64 +1812,113 @@ def convert_eggnog_to_homologs(sm, EGGs, og_key = 'eggNOG_OGs', taxon=2759):
         Taxonomic ID corresponding to the level at which genes with overlapping orthology groups
         will be considered homologs. Defaults to the Eukaryotic level.
         
+    path: str, optional, default None
+        If passed, homolog pairs are appended to this tab-separated file chunk by chunk instead of
+        being held in memory, and the path is returned. Pairs in the file are sorted within each
+        row but not across rows.
+        
+    chunk_size: int, optional, default 1000000
+        Approximate number of candidate pairs generated at a time.
+
+    eggnog_cache: bool or str, optional, default True
+        Caching of parsed eggNOG-mapper files passed in `EGGs` (see `cache` in `load_eggnog_annotations`).
+        
     Returns
     -------
-    homolog_pairs: n x 2 numpy array of homolog pairs.
+    homolog_pairs: n x 2 numpy array of homolog pairs (or `path`).
     """
     smp = sm.samap
     
     taxon = str(taxon)
-    EGGs = dict(zip(list(EGGs.keys()),list(EGGs.values()))) #copying
-    for k in EGGs.keys():
-        EGGs[k] = EGGs[k].copy()
-
-    Es=[]    
-    for k in EGGs.keys():
-        A=EGGs[k]
-        A.index=k+"_"+A.index
-        Es.append(A)
-    
-    A = pd.concat(Es, axis=0)
+    A = _prefixed_annotations(EGGs, og_key, cache=eggnog_cache)
     gn = q(smp.adata.var_names)
-    A = A[np.in1d(q(A.index), gn)]
-
-    orthology_groups = A[og_key]
-    og = q(orthology_groups)
-    x = np.unique(",".join(og).split(","))
-    D = pd.DataFrame(data=np.arange(x.size)[None, :], columns=x)
-
-    for i in range(og.size):
-        n = orthology_groups[i].split(",")
-        taxa = substr(substr(n, "@", 1),'|',0)
-        if (taxa == "2759").sum() > 1 and taxon == '2759':
-            og[i] = ""
-        else:
-            og[i] = "".join(np.array(n)[taxa == taxon])
-
-    A[og_key] = og
-
-    og = q(A[og_key].reindex(gn))
-    og[og == "nan"] = ""
-
-    X = []
-    Y = []
-    for i in range(og.size):
-        x = og[i]
-        if x != "":
-            X.extend(D[x].values.flatten())
-            Y.extend([i])
-
-    X = np.array(X)
-    Y = np.array(Y)
-    B = sp.sparse.lil_matrix((og.size, D.size))
-    B[Y, X] = 1
-    B = B.tocsr()
-    B = B.dot(B.T)
-    B.data[:] = 1
-    pairs = gn[np.vstack((B.nonzero())).T]
-    pairssp = np.vstack([q([x.split('_')[0] for x in xx]) for xx in pairs])
-    return np.unique(np.sort(pairs[pairssp[:,0]!=pairssp[:,1]],axis=1),axis=0)
-
+    A = A[np.logical_and(np.in1d(q(A.index), gn), ~pd.isnull(A.values))]
+
+    # orthogroup of each gene at the requested taxonomic level
+    tokens = pd.Series(q(A).astype('str'), index=np.arange(A.size)).str.split(",").explode()
+    taxa = tokens.str.split("@").str[1].fillna(tokens).str.split("|").str[0]
+    og = tokens[(taxa == taxon).values].groupby(level=0, sort=False).agg("".join)
+    if taxon == '2759':
+        n = (taxa == "2759").groupby(level=0).sum()
+        og = og[q(n.reindex(og.index)) <= 1]
+    og = pd.Series(q(og), index=q(A.index)[q(og.index).astype('int')])
+
+    groups = pd.factorize(q(og.reindex(gn).fillna("")))[0]
+    groups[q(og.reindex(gn).isnull())] = -1
+    species = np.unique(substr(gn, '_', 0), return_inverse=True)[1]
+
+    chunks = _grouped_pairs(groups, species, chunk_size=chunk_size)
+    if path is not None:
+        open(path, 'w').close()
+        for i, j in chunks:
+            pd.DataFrame(np.sort(gn[np.vstack((i, j)).T], axis=1)).to_csv(
+                path, sep='\t', header=False, index=False, mode='a')
+        return path
+
+    pairs = [np.vstack((i, j)).T for i, j in chunks]
+    pairs = np.vstack(pairs) if len(pairs) > 0 else np.zeros((0, 2), dtype='int')
+    # gene indices follow the sorted order of the names, so sorting indices sorts the names
+    order = np.argsort(gn, kind='stable')
+    rank = np.empty(gn.size, dtype='int')
+    rank[order] = np.arange(gn.size)
+    pairs = np.unique(np.sort(rank[pairs], axis=1), axis=0)
+    return gn[order][pairs]
+
+
+def _triangles(A, chunk_size=1000000):
+    """Enumerates the triangles of the undirected graph with sparse adjacency matrix `A`.
+    
+    Edges are oriented from lower to higher (degree, index) rank, so every triangle is found
+    exactly once from its lowest-ranked vertex: each pair of that vertex's sorted out-neighbours
+    is looked up in the sorted oriented edge list. Only triangles are enumerated, and the work is
+    bounded by the number of such wedges rather than by the number of cliques.
+    
+    Parameters
+    ----------
+    A - scipy.sparse matrix (n x n)
+        Nonzero entries (in either direction) are edges; the diagonal is ignored.
+        
+    chunk_size - int, optional, default 1000000
+        Approximate number of wedges checked at a time.
+        
+    Returns
+    -------
+    T - numpy.ndarray (triangles x 3) of vertex indices, i < j < k, sorted lexicographically
+    
+    W - numpy.ndarray (triangles x 3) of the weights of edges (i, j), (i, k) and (j, k),
+        taking the larger of the two directions.
+    """
+    A = sp.sparse.csr_matrix(A)
+    A = A.maximum(A.T).tocsr()
+    A.setdiag(0)
+    A.eliminate_zeros()
+    n = A.shape[0]
+    deg = np.diff(A.indptr)
+    order = np.lexsort((np.arange(n), deg))
+    rank = np.empty(n, dtype='int')
+    rank[order] = np.arange(n)
+
+    x = rank[np.repeat(np.arange(n), deg)]
+    y = rank[A.indices]
+    f = x < y
+    O = sp.sparse.csr_matrix((np.ones(f.sum()), (x[f], y[f])), shape=(n, n))
+    O.sort_indices()
+    rows = np.repeat(np.arange(n), np.diff(O.indptr))
+    edges = rows.astype('int64') * n + O.indices
+
+    T = []
+    for i, j in _grouped_pairs(rows, chunk_size=chunk_size):
+        v, w = O.indices[i], O.indices[j]
+        keys = v.astype('int64') * n + w
+        ix = np.minimum(np.searchsorted(edges, keys), max(edges.size - 1, 0))
+        hit = edges[ix] == keys if edges.size > 0 else np.zeros(keys.size, dtype='bool')
+        T.append(np.vstack((rows[i][hit], v[hit], w[hit])).T)
+    T = np.vstack(T) if len(T) > 0 else np.zeros((0, 3), dtype='int')
+    T = np.sort(order[T], axis=1)
+    T = T[np.lexsort(T.T[::-1])]
+    W = np.vstack([np.asarray(A[T[:, a], T[:, b]]).flatten() if T.shape[0] > 0 else np.zeros(0)
+                   for a, b in [(0, 1), (0, 2), (1, 2)]]).T
+    return T, W
 
 def CellTypeTriangles(sm,keys, align_thr=0.1):
     """Outputs a table of cell type triangles.
@@ -1160,23 +1952,272 @@ def CellTypeTriangles(sm,keys, align_thr=0.1):
     nnm[Z[y].values.flatten(), Z[x].values.flatten()] = alignment
     nnm = nnm.tocsr()
 
-    import networkx as nx
-
-    G = nx.Graph()
-    gps=ctu[np.vstack(nnm.nonzero()).T]
-    G.add_edges_from(gps)
-    alignment = pd.Series(index=to_vn(gps),data=nnm.data)
-    all_triangles = [c for c in nx.enumerate_all_cliques(G) if len(c)==3]
-    Z = np.sort(np.vstack(all_triangles), axis=1)
+    T, W = _triangles(nnm)
+    if T.shape[0] == 0:
+        return pd.DataFrame(columns=sm.ids)
+    Z = ctu[T]
     DF = pd.DataFrame(data=Z, columns=[x.split("_")[0] for x in Z[0]])
-    for i,sid1 in enumerate(sm.ids):
-        for sid2 in sm.ids[i:]:
-            if sid1!=sid2:
-                DF[sid1+';'+sid2] = [alignment[x] for x in DF[sid1].values.astype('str').astype('object')+';'+DF[sid2].values.astype('str').astype('object')]
+    for a, b, w in zip([0, 0, 1], [1, 2, 2], W.T):
+        DF[DF.columns[a]+';'+DF.columns[b]] = w
     DF = DF[sm.ids]
     return DF
 
-def GeneTriangles(sm,orth,keys=None,compute_markers=True,corr_thr=0.3, psub_thr = 0.3, pval_thr=1e-10):
+def _species_pair_blocks(gnnm, gnsp):
+    """Splits a homology graph into COO triplets `(rows, cols, data)` keyed by species pair.
+    
+    Rows and columns are global gene indices; within-species edges and explicit zeros are dropped.
+    """
+    G = sp.sparse.coo_matrix(gnnm)
+    species, codes = np.unique(gnsp, return_inverse=True)
+    f = np.logical_and(G.data != 0, codes[G.row] != codes[G.col])
+    r, c, d = G.row[f], G.col[f], G.data[f]
+    key = codes[r] * species.size + codes[c]
+    order = np.argsort(key, kind='stable')
+    r, c, d, key = r[order], c[order], d[order], key[order]
+    bounds = np.searchsorted(key, np.arange(species.size ** 2 + 1))
+    blocks = {}
+    for i in range(species.size):
+        for j in range(species.size):
+            k = i * species.size + j
+            if bounds[k + 1] > bounds[k]:
+                blocks[(species[i], species[j])] = (r[bounds[k]:bounds[k + 1]], c[bounds[k]:bounds[k + 1]],
+                                                    d[bounds[k]:bounds[k + 1]])
+    return blocks
+
+def _pair_keys(pairs, gix):
+    """Integer keys of the gene pairs (rows of `pairs`), -1 where a gene is not in the index `gix`."""
+    x, y = gix.get_indexer(pairs[:, 0]), gix.get_indexer(pairs[:, 1])
+    keys = x.astype('int64') * gix.size + y
+    keys[(x < 0) | (y < 0)] = -1
+    return keys
+
+def _pair_values(keys, ref, values):
+    """Values of the pairs `keys` looked up in the (unique) reference keys `ref`."""
+    o = np.argsort(ref)
+    ix = np.searchsorted(ref[o], keys).clip(max=max(ref.size - 1, 0))
+    if keys.size > 0 and (ref.size == 0 or (ref[o][ix] != keys).any()):
+        raise KeyError('gene pairs missing from the homology graph')
+    return values[o][ix]
+
+def _substituted_genes(pp, op, gix):
+    """Ortholog genes substituted by each paralog pair.
+
+    For every paralog pair in `pp` (both orientations), collects the genes of
+    its ortholog pairs (matching rows of `op`) that are not among the paralogs.
+    Returns the sorted paralog pair keys and the ';'-joined, sorted genes.
+    """
+    pp, op = np.vstack((pp, pp[:, ::-1])).astype(str), np.vstack((op, op)).astype(str)
+    keys = _pair_keys(pp, gix)
+    P = np.unique(keys[keys >= 0])
+    k, g = np.tile(keys, 2), np.append(op[:, 0], op[:, 1])
+    f = (k >= 0) & (g != np.tile(pp[:, 0], 2)) & (g != np.tile(pp[:, 1], 2))
+    k, g = k[f], g[f]
+    o = np.lexsort((g, k))
+    k, g = k[o], g[o]
+    f = np.append(True, (k[1:] != k[:-1]) | (g[1:] != g[:-1]))
+    k, g = k[f], g[f]
+    S = np.zeros(P.size, dtype='object')
+    for j, (a, b) in enumerate(zip(np.searchsorted(k, P), np.searchsorted(k, P, side='right'))):
+        S[j] = ';'.join(g[a:b])
+    return P, S
+
+def _gene_triangles_triplet(comb, sm, orth, orthsp, RES, ops, pps, doPsubsAll, blocks, gn, gix,
+                            keys=None, corr_thr=0.3, pval_thr=1e-10):
+    """Gene triangles of one species triplet `comb` (see `GeneTriangles`)."""
+    A,B,C = comb
+    sam1=sm.sams[A]
+    sam2=sm.sams[B]
+    sam3=sm.sams[C]
+    A1,A2=A,B
+    B1,B2=A,C
+    C1,C2=B,C
+
+    f1 = ((orthsp[:,0]==A1) * (orthsp[:,1]==A2) + (orthsp[:,0]==A2) * (orthsp[:,1]==A1)) > 0
+    f2 = ((orthsp[:,0]==B1) * (orthsp[:,1]==B2) + (orthsp[:,0]==B2) * (orthsp[:,1]==B1)) > 0
+    f3 = ((orthsp[:,0]==C1) * (orthsp[:,1]==C2) + (orthsp[:,0]==C2) * (orthsp[:,1]==C1)) > 0
+    orth1 = orth[f1]
+    orth2 = orth[f2]
+    orth3 = orth[f3]
+
+
+    if doPsubsAll:
+        f1 = np.logical_and(((ops[:,0]==A1) * (ops[:,1]==A2) + (ops[:,0]==A2) * (ops[:,1]==A1)) > 0,
+                            ((pps[:,0]==A1) * (pps[:,1]==A2) + (pps[:,0]==A2) * (pps[:,1]==A1)) > 0)
+        f2 = np.logical_and(((ops[:,0]==B1) * (ops[:,1]==B2) + (ops[:,0]==B2) * (ops[:,1]==B1)) > 0,
+                            ((pps[:,0]==B1) * (pps[:,1]==B2) + (pps[:,0]==B2) * (pps[:,1]==B1)) > 0)
+        f3 = np.logical_and(((ops[:,0]==C1) * (ops[:,1]==C2) + (ops[:,0]==C2) * (ops[:,1]==C1)) > 0,
+                            ((pps[:,0]==C1) * (pps[:,1]==C2) + (pps[:,0]==C2) * (pps[:,1]==C1)) > 0)
+        doPsubs = f1.sum() > 0 and f2.sum() > 0 and f3.sum() > 0
+    else:
+        doPsubs = False
+
+    if doPsubs:
+        RES1=RES[f1]
+        RES2=RES[f2]
+        RES3=RES[f3]
+
+
+        op1 = to_vo(q(RES1["ortholog pairs"]))
+        op2 = to_vo(q(RES2["ortholog pairs"]))
+        op3 = to_vo(q(RES3["ortholog pairs"]))
+        pp1 = to_vo(q(RES1["paralog pairs"]))
+        pp2 = to_vo(q(RES2["paralog pairs"]))
+        pp3 = to_vo(q(RES3["paralog pairs"]))
+
+
+    # homology edges of each species pair in both directions, as COO triplets over global gene ids
+    rows, cols, data = [], [], []
+    for s1, s2 in [(A1, A2), (B1, B2), (C1, C2)]:
+        empty = (np.zeros(0, dtype='int'),) * 2 + (np.zeros(0),)
+        r12, c12, d12 = blocks.get((s1, s2), empty)
+        r21, c21, d21 = blocks.get((s2, s1), empty)
+        rows.append(np.append(r12, r21))
+        cols.append(np.append(c12, c21))
+        data.append(np.append(d12, d21))
+
+    if doPsubs:
+        # ortholog pairs of the substitutions are kept as (weak) edges even if absent from the graph
+        for k, op in enumerate([op1, op2, op3]):
+            x, y = gix.get_indexer(op[:, 0]), gix.get_indexer(op[:, 1])
+            edges = np.append(x.astype('int64') * gn.size + y, y.astype('int64') * gn.size + x)
+            new = np.setdiff1d(edges, rows[k].astype('int64') * gn.size + cols[k])
+            rows[k] = np.append(rows[k], new // gn.size)
+            cols[k] = np.append(cols[k], new % gn.size)
+            data[k] = np.append(data[k], np.full(new.size, 1e-4))
+
+    # homology graph of the triplet over its genes in name order
+    EDGES = [(rows[k].astype('int64') * gn.size + cols[k], data[k]) for k in range(3)]
+    rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+    used = np.unique(np.append(rows, cols))
+    order = np.argsort(gn[used], kind='stable')
+    all_genes = gn[used][order]
+    relabel = np.empty(gn.size, dtype='int')
+    relabel[used[order]] = np.arange(used.size)
+    f = data >= corr_thr
+    GNNM = sp.sparse.coo_matrix((data[f], (relabel[rows[f]], relabel[cols[f]])), shape=(used.size,) * 2).tocsr()
+    Z = all_genes[_triangles(GNNM)[0]]
+        
+    DF = pd.DataFrame(data=Z, columns=[x.split("_")[0] for x in Z[0]])
+    DF = DF[[A, B, C]]
+
+    AB = to_vn(DF[[A, B]].values)
+    AC = to_vn(DF[[A, C]].values)
+    BC = to_vn(DF[[B, C]].values)
+
+    AVs = []
+    CATs = []
+    CORRs = []
+    for i, X, pair, O in zip([0, 1, 2], [AB, AC, BC], [[A, B], [A, C], [B, C]], [orth1, orth2, orth3]):
+        x = _pair_keys(DF[pair].values, gix)
+        cat = q(["homolog"] * X.size).astype("object")
+        cat[np.in1d(x, _pair_keys(np.vstack((O, O[:, ::-1])), gix))] = "ortholog"
+        AV = np.zeros(X.size, dtype="object")
+        if doPsubs:
+            P, S = _substituted_genes([pp1, pp2, pp3][i], [op1, op2, op3][i], gix)
+            ff = np.in1d(x, P)
+            cat[ff] = "substitution"
+            AV[ff] = S[np.searchsorted(P, x[ff])]
+        AVs.append(AV)
+        CATs.append(cat)
+        CORRs.append(_pair_values(x, *EDGES[i]))
+
+    tri_pairs = np.vstack((AB, AC, BC)).T
+    cat_pairs = np.vstack(CATs).T
+    corr_pairs = np.vstack(CORRs).T
+    homology_triangles = DF.values
+    substituted_genes = np.vstack(AVs).T
+    substituted_genes[substituted_genes == 0] = "N.S."
+    data = np.hstack(
+        (
+            homology_triangles.astype("object"),
+            substituted_genes.astype("object"),
+            tri_pairs.astype("object"),
+            corr_pairs.astype("object"),
+            cat_pairs.astype("object"),
+        )
+    )
+
+    FINAL = pd.DataFrame(data = data, columns = [f'{A} gene',f'{B} gene',f'{C} gene',
+                                                f'{A}/{B} subbed',f'{A}/{C} subbed',f'{B}/{C} subbed',
+                                                f'{A}/{B}',f'{A}/{C}',f'{B}/{C}',
+                                                f'{A}/{B} corr',f'{A}/{C} corr',f'{B}/{C} corr',
+                                                f'{A}/{B} type',f'{A}/{C} type',f'{B}/{C} type'])
+    FINAL['#orthologs'] = (cat_pairs=='ortholog').sum(1)
+    FINAL['#substitutions'] = (cat_pairs=='substitution').sum(1)    
+    FINAL = FINAL[(FINAL['#orthologs']+FINAL['#substitutions'])==3]
+    x = FINAL[[f'{A}/{B} corr',f'{A}/{C} corr',f'{B}/{C} corr']].min(1)
+    FINAL['min_corr'] = x
+    FINAL = FINAL[x>corr_thr]
+    if keys is not None:
+        keys = [keys[A],keys[B],keys[C]]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if keys is not None:
+            for i,sam,n in zip([0,1,2],[sam1,sam2,sam3],[A,B,C]):
+                a = sam.adata.varm[keys[i]+'_scores'].T[q(FINAL[n+' gene'])].T
+                p = sam.adata.varm[keys[i]+'_pvals'].T[q(FINAL[n+' gene'])].T.values
+                p[p>pval_thr]=1
+                p[p<1]=0
+                p=1-p
+                f = a.columns[a.values.argmax(1)]
+                res=[]
+                for i in range(p.shape[0]):
+                    res.append(';'.join(np.unique(np.append(f[i],a.columns[p[i,:]==1]))))            
+                FINAL[n+' cell type'] = res
+    FINAL = FINAL.sort_values('min_corr',ascending=False)
+    return FINAL
+
+_GENE_TRIANGLE_WORKER = {}
+def _resident_memory():
+    # (current, peak) resident memory of this process in bytes from /proc, or None if unavailable
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if line.startswith(('VmRSS', 'VmHWM')))
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _reset_peak_resident_memory():
+    # resets the peak (VmHWM) to the current resident memory on Linux; False if unsupported
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _gene_triangles_worker(job):
+    comb, path, trace_memory = job
+    if trace_memory:
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+    else:
+        start = _resident_memory() if _reset_peak_resident_memory() else None
+    FINAL = _gene_triangles_triplet(comb, **_GENE_TRIANGLE_WORKER)
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        memory = ', peak traced memory {:.1f} MB'.format(peak / 1e6)
+    else:
+        end = _resident_memory() if start is not None else None
+        memory = '' if end is None else ', peak resident memory {:.1f} MB ({:+.1f} MB over its start)'.format(
+            end[1] / 1e6, (end[1] - start[0]) / 1e6)
+    print('Gene triangles for {}/{}/{}: {} triangles{}.'.format(*comb, FINAL.shape[0], memory))
+    if path is None:
+        return FINAL
+    import os
+    fn = os.path.join(path, '{}_{}_{}.csv'.format(*comb))
+    FINAL.to_csv(fn + '.tmp')
+    os.replace(fn + '.tmp', fn)
+    return fn
+
+def GeneTriangles(sm,orth,keys=None,compute_markers=True,corr_thr=0.3, psub_thr = 0.3, pval_thr=1e-10,
+                  marker_cache=None, marker_max_cells=None, n_jobs=1, path=None, trace_memory=False):
     """Outputs a table of gene triangles.
     
     Parameters
@@ -1197,8 +2238,30 @@ def GeneTriangles(sm,orth,keys=None,compute_markers=True,corr_thr=0.3, psub_thr
         
     pval_thr: float, optional, defaul, 1e-10
         Consider cell types as differentially expressed if their p-values are less than `pval_thr`.
+        
+    marker_cache: str, optional, default None
+        Directory of a persistent cluster marker cache (see `find_cluster_markers`).
+        
+    marker_max_cells: int, optional, default None
+        If set, cluster markers are computed in approximate mode on at most this many cells
+        per cluster (see `find_cluster_markers`).
+        
+    n_jobs: int, optional, default 1
+        Number of worker processes handling species triplets concurrently. Workers are forked
+        after all inputs (including cluster markers) are prepared and only read them. Cluster
+        markers are computed with the same number of workers beforehand.
+        
+    path: str, optional, default None
+        If passed, each triplet's table is written to `{path}/{A}_{B}_{C}.csv` as soon as it is
+        done instead of being kept in memory, and the list of written files is returned.
+        
+    trace_memory: bool, optional, default False
+        If True, reports the peak memory allocated while processing each triplet, traced with
+        `tracemalloc`. Tracing slows the computation down considerably. Otherwise, on Linux, the
+        process's peak resident memory is reset before each triplet (via `/proc/self/clear_refs`)
+        and the peak reached during the triplet is reported along with its growth over the
+        resident memory at the start of the triplet. Elsewhere, no memory figure is reported.
     """
-    FINALS = []
 
     orth = np.sort(orth,axis=1)
     orthsp = np.vstack([q([x.split('_')[0] for x in xx]) for xx in orth])
@@ -1211,297 +2274,224 @@ def GeneTriangles(sm,orth,keys=None,compute_markers=True,corr_thr=0.3, psub_thr
         pps = np.vstack([q([x.split('_')[0] for x in xx]) for xx in pp])
         doPsubsAll=True
     else:
+        ops,pps = None,None
         doPsubsAll=False
     gnnm = sm.samap.adata.varp["homology_graph_reweighted"]
     gn = q(sm.samap.adata.var_names)
     gnsp = q([x.split('_')[0] for x in gn])
+    blocks = _species_pair_blocks(gnnm, gnsp)
 
-    import itertools
-    combs = list(itertools.combinations(sm.ids,3))
-    for comb in combs:
-        A,B,C = comb
-        smp1 = SAM(counts=sm.samap.adata[np.logical_or(sm.samap.adata.obs['species']==A,sm.samap.adata.obs['species']==B)])
-        smp2 = SAM(counts=sm.samap.adata[np.logical_or(sm.samap.adata.obs['species']==A,sm.samap.adata.obs['species']==C)])
-        smp3 = SAM(counts=sm.samap.adata[np.logical_or(sm.samap.adata.obs['species']==B,sm.samap.adata.obs['species']==C)])
-
-        sam1=sm.sams[A]
-        sam2=sm.sams[B]
-        sam3=sm.sams[C]
-        A1,A2=A,B
-        B1,B2=A,C
-        C1,C2=B,C
-
-        f1 = ((orthsp[:,0]==A1) * (orthsp[:,1]==A2) + (orthsp[:,0]==A2) * (orthsp[:,1]==A1)) > 0
-        f2 = ((orthsp[:,0]==B1) * (orthsp[:,1]==B2) + (orthsp[:,0]==B2) * (orthsp[:,1]==B1)) > 0
-        f3 = ((orthsp[:,0]==C1) * (orthsp[:,1]==C2) + (orthsp[:,0]==C2) * (orthsp[:,1]==C1)) > 0
-        orth1 = orth[f1]
-        orth2 = orth[f2]
-        orth3 = orth[f3]
-
-
-        gnnm1 = sp.sparse.vstack((
-                                    sp.sparse.hstack((sp.sparse.csr_matrix(((gnsp==A1).sum(),)*2),gnnm[gnsp==A1,:][:,gnsp==A2])),
-                                    sp.sparse.hstack((gnnm[gnsp==A2,:][:,gnsp==A1],sp.sparse.csr_matrix(((gnsp==A2).sum(),)*2)))
-                                )).tocsr()
-        gnnm2 = sp.sparse.vstack((
-                                    sp.sparse.hstack((sp.sparse.csr_matrix(((gnsp==B1).sum(),)*2),gnnm[gnsp==B1,:][:,gnsp==B2])),
-                                    sp.sparse.hstack((gnnm[gnsp==B2,:][:,gnsp==B1],sp.sparse.csr_matrix(((gnsp==B2).sum(),)*2)))
-                                )).tocsr()
-        gnnm3 = sp.sparse.vstack((
-                                    sp.sparse.hstack((sp.sparse.csr_matrix(((gnsp==C1).sum(),)*2),gnnm[gnsp==C1,:][:,gnsp==C2])),
-                                    sp.sparse.hstack((gnnm[gnsp==C2,:][:,gnsp==C1],sp.sparse.csr_matrix(((gnsp==C2).sum(),)*2)))
-                                )).tocsr()                                                                
-        gn1 = np.append(gn[gnsp==A1],gn[gnsp==A2])
-        gn2 = np.append(gn[gnsp==B1],gn[gnsp==B2])
-        gn3 = np.append(gn[gnsp==C1],gn[gnsp==C2])
-
-
-        if doPsubsAll:
-            f1 = np.logical_and(((ops[:,0]==A1) * (ops[:,1]==A2) + (ops[:,0]==A2) * (ops[:,1]==A1)) > 0,
-                                ((pps[:,0]==A1) * (pps[:,1]==A2) + (pps[:,0]==A2) * (pps[:,1]==A1)) > 0)
-            f2 = np.logical_and(((ops[:,0]==B1) * (ops[:,1]==B2) + (ops[:,0]==B2) * (ops[:,1]==B1)) > 0,
-                                ((pps[:,0]==B1) * (pps[:,1]==B2) + (pps[:,0]==B2) * (pps[:,1]==B1)) > 0)
-            f3 = np.logical_and(((ops[:,0]==C1) * (ops[:,1]==C2) + (ops[:,0]==C2) * (ops[:,1]==C1)) > 0,
-                                ((pps[:,0]==C1) * (pps[:,1]==C2) + (pps[:,0]==C2) * (pps[:,1]==C1)) > 0)
-            doPsubs = f1.sum() > 0 and f2.sum() > 0 and f3.sum() > 0
-        else:
-            doPsubs = False
-
-        if doPsubs:
-            RES1=RES[f1]
-            RES2=RES[f2]
-            RES3=RES[f3]
-
-
-            op1 = to_vo(q(RES1["ortholog pairs"]))
-            op2 = to_vo(q(RES2["ortholog pairs"]))
-            op3 = to_vo(q(RES3["ortholog pairs"]))
-            pp1 = to_vo(q(RES1["paralog pairs"]))
-            pp2 = to_vo(q(RES2["paralog pairs"]))
-            pp3 = to_vo(q(RES3["paralog pairs"]))
-
-
-            # suppress warning
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                T1 = pd.DataFrame(data=np.arange(gn1.size)[None, :], columns=gn1)
-                x, y = T1[op1[:, 0]].values.flatten(), T1[op1[:, 1]].values.flatten()
-                gnnm1[x, y] = gnnm1[x, y]
-                gnnm1[y, x] = gnnm1[y, x]
-
-                T1 = pd.DataFrame(data=np.arange(gn2.size)[None, :], columns=gn2)
-                x, y = T1[op2[:, 0]].values.flatten(), T1[op2[:, 1]].values.flatten()
-                gnnm2[x, y] = gnnm2[x, y]
-                gnnm2[y, x] = gnnm2[y, x]
-
-                T1 = pd.DataFrame(data=np.arange(gn3.size)[None, :], columns=gn3)
-                x, y = T1[op3[:, 0]].values.flatten(), T1[op3[:, 1]].values.flatten()
-                gnnm3[x, y] = gnnm3[x, y]
-                gnnm3[y, x] = gnnm3[y, x]
-
-            gnnm1.data[gnnm1.data==0]=1e-4
-            gnnm2.data[gnnm2.data==0]=1e-4
-            gnnm3.data[gnnm3.data==0]=1e-4
-
-        pairs1 = gn1[np.vstack(gnnm1.nonzero()).T]
-        pairs2 = gn2[np.vstack(gnnm2.nonzero()).T]
-        pairs3 = gn3[np.vstack(gnnm3.nonzero()).T]
-        data = np.concatenate((gnnm1.data, gnnm2.data, gnnm3.data))
-
-        CORR1 = pd.DataFrame(data=gnnm1.data[None, :], columns=to_vn(pairs1))
-        CORR2 = pd.DataFrame(data=gnnm2.data[None, :], columns=to_vn(pairs2))
-        CORR3 = pd.DataFrame(data=gnnm3.data[None, :], columns=to_vn(pairs3))
-
-        pairs = np.vstack((pairs1, pairs2, pairs3))
-        all_genes = np.unique(pairs.flatten())
-        Z = pd.DataFrame(data=np.arange(all_genes.size)[None, :], columns=all_genes)
-        x, y = Z[pairs[:, 0]].values.flatten(), Z[pairs[:, 1]].values.flatten()
-        GNNM = sp.sparse.lil_matrix((all_genes.size,) * 2)
-        GNNM[x, y] = data
-        GNNM=GNNM.tocsr()
-        GNNM.data[GNNM.data<corr_thr]=0
-        GNNM.eliminate_zeros()
-
-        G = nx.from_scipy_sparse_array(GNNM, create_using=nx.Graph)
-        all_triangles = [c for c in nx.enumerate_all_cliques(G) if len(c)==3]
-        Z = all_genes[np.sort(np.vstack(all_triangles), axis=1)] 
-        
-        DF = pd.DataFrame(data=Z, columns=[x.split("_")[0] for x in Z[0]])
-        DF = DF[[A, B, C]]
-
-        orth1DF = pd.DataFrame(data=orth1, columns=[x.split("_")[0] for x in orth1[0]])[
-            [A, B]
-        ]
-        orth2DF = pd.DataFrame(data=orth2, columns=[x.split("_")[0] for x in orth2[0]])[
-            [A, C]
-        ]
-        orth3DF = pd.DataFrame(data=orth3, columns=[x.split("_")[0] for x in orth3[0]])[
-            [B, C]
-        ]
+    if keys is not None and compute_markers:
+        for sid in sm.ids:
+            find_cluster_markers(sm.sams[sid],keys[sid],cache=marker_cache,max_cells=marker_max_cells,
+                                 n_jobs=n_jobs)
 
-        if doPsubs:
-            ps1DF = pd.DataFrame(
-                data=np.sort(pp1, axis=1),
-                columns=[x.split("_")[0] for x in np.sort(pp1, axis=1)[0]],
-            )[[A, B]]
-            ps2DF = pd.DataFrame(
-                data=np.sort(pp2, axis=1),
-                columns=[x.split("_")[0] for x in np.sort(pp2, axis=1)[0]],
-            )[[A, C]]
-            ps3DF = pd.DataFrame(
-                data=np.sort(pp3, axis=1),
-                columns=[x.split("_")[0] for x in np.sort(pp3, axis=1)[0]],
-            )[[B, C]]
-
-            A_AB = pd.DataFrame(data=to_vn(op1)[None, :], columns=to_vn(ps1DF.values))
-            A_AC = pd.DataFrame(data=to_vn(op2)[None, :], columns=to_vn(ps2DF.values))
-            A_BC = pd.DataFrame(data=to_vn(op3)[None, :], columns=to_vn(ps3DF.values))
+    _GENE_TRIANGLE_WORKER.update(sm=sm, orth=orth, orthsp=orthsp, RES=RES, ops=ops, pps=pps, doPsubsAll=doPsubsAll,
+                                 blocks=blocks, gn=gn, gix=pd.Index(gn), keys=keys, corr_thr=corr_thr,
+                                 pval_thr=pval_thr)
+    import itertools
+    jobs = [(comb, path, trace_memory) for comb in itertools.combinations(sm.ids,3)]
+    if path is not None:
+        import os
+        os.makedirs(path, exist_ok=True)
+    try:
+        if n_jobs > 1 and len(jobs) > 1:
+            import multiprocessing
+            with multiprocessing.get_context('fork').Pool(n_jobs) as pool:
+                FINALS = list(pool.imap(_gene_triangles_worker, jobs))
         else:
-            ps1DF,ps2DF,ps3DF = None,None,None
-            A_AB,A_AC,A_BC = None,None,None
-
-        AB = to_vn(DF[[A, B]].values)
-        AC = to_vn(DF[[A, C]].values)
-        BC = to_vn(DF[[B, C]].values)
-
-        AVs = []
-        CATs = []
-        CORRs = []
-        for i, X, O, P, Z, R in zip(
-            [0, 1, 2],
-            [AB, AC, BC],
-            [orth1DF, orth2DF, orth3DF],
-            [ps1DF, ps2DF, ps3DF],
-            [A_AB, A_AC, A_BC],
-            [CORR1, CORR2, CORR3],
-        ):
-            cat = q(["homolog"] * X.size).astype("object")
-            cat[np.in1d(X, to_vn(O.values))] = "ortholog"
-            AV = np.zeros(X.size, dtype="object")
-            if doPsubs:
-                ff = np.in1d(X, to_vn(P.values))
-                cat[ff] = "substitution"
-
-                z = Z[X[ff]] #problem line here
-                x = X[ff]
-                av = np.zeros(x.size, dtype="object")
-                for ai in range(x.size):
-                    v=pd.DataFrame(z[x[ai]]) #get ortholog pairs - paralog pairs dataframe
-                    vd=v.values.flatten() #get ortholog pairs
-                    vc=q(';'.join(v.columns).split(';')) # get paralogous genes
-                    temp = np.unique(q(';'.join(vd).split(';'))) #get orthologous genes
-                    av[ai] = ';'.join(temp[np.in1d(temp,vc,invert=True)]) #get orthologous genes not present in paralogous genes
-                AV[ff] = av
-            corr = R[X].values.flatten()
-            AVs.append(AV)
-            CATs.append(cat)
-            CORRs.append(corr)
-
-        tri_pairs = np.vstack((AB, AC, BC)).T
-        cat_pairs = np.vstack(CATs).T
-        corr_pairs = np.vstack(CORRs).T
-        homology_triangles = DF.values
-        substituted_genes = np.vstack(AVs).T
-        substituted_genes[substituted_genes == 0] = "N.S."
-        data = np.hstack(
-            (
-                homology_triangles.astype("object"),
-                substituted_genes.astype("object"),
-                tri_pairs.astype("object"),
-                corr_pairs.astype("object"),
-                cat_pairs.astype("object"),
-            )
-        )
-
-        FINAL = pd.DataFrame(data = data, columns = [f'{A} gene',f'{B} gene',f'{C} gene',
-                                                    f'{A}/{B} subbed',f'{A}/{C} subbed',f'{B}/{C} subbed',
-                                                    f'{A}/{B}',f'{A}/{C}',f'{B}/{C}',
-                                                    f'{A}/{B} corr',f'{A}/{C} corr',f'{B}/{C} corr',
-                                                    f'{A}/{B} type',f'{A}/{C} type',f'{B}/{C} type'])
-        FINAL['#orthologs'] = (cat_pairs=='ortholog').sum(1)
-        FINAL['#substitutions'] = (cat_pairs=='substitution').sum(1)    
-        FINAL = FINAL[(FINAL['#orthologs']+FINAL['#substitutions'])==3]
-        x = FINAL[[f'{A}/{B} corr',f'{A}/{C} corr',f'{B}/{C} corr']].min(1)
-        FINAL['min_corr'] = x
-        FINAL = FINAL[x>corr_thr]
-        if keys is not None:
-            keys = [keys[A],keys[B],keys[C]]
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            if keys is not None:
-                for i,sam,n in zip([0,1,2],[sam1,sam2,sam3],[A,B,C]):
-                    if compute_markers:
-                        find_cluster_markers(sam,keys[i])
-                    a = sam.adata.varm[keys[i]+'_scores'].T[q(FINAL[n+' gene'])].T
-                    p = sam.adata.varm[keys[i]+'_pvals'].T[q(FINAL[n+' gene'])].T.values
-                    p[p>pval_thr]=1
-                    p[p<1]=0
-                    p=1-p
-                    f = a.columns[a.values.argmax(1)]
-                    res=[]
-                    for i in range(p.shape[0]):
-                        res.append(';'.join(np.unique(np.append(f[i],a.columns[p[i,:]==1]))))            
-                    FINAL[n+' cell type'] = res
-        FINAL = FINAL.sort_values('min_corr',ascending=False)
-        FINALS.append(FINAL)
+            FINALS = [_gene_triangles_worker(job) for job in jobs]
+    finally:
+        _GENE_TRIANGLE_WORKER.clear()
+    if path is not None:
+        return FINALS
     FINAL = pd.concat(FINALS,axis=0)
     return FINAL
 
-def _compute_csim(samap, key, X=None, prepend=True, n_top = 0):
-    splabels = q(samap.adata.obs['species'])
+def _cluster_codes(splabels, labels):
     skeys = splabels[np.sort(np.unique(splabels,return_index=True)[1])]
 
-    cl = []
-    clu = []
+    # integer cluster codes per cell, clusters ordered species by species.
+    # cells without a label (species outside of the keys) are masked with -1.
+    valid = ~pd.isnull(labels)
+    codes = np.zeros(labels.size, dtype='int') - 1
+    clu = [np.array([], dtype='object')]
+    offset = 0
     for sid in skeys:
-        if prepend:
-            cl.append(sid+'_'+q(samap.adata.obs[key])[samap.adata.obs['species']==sid].astype('str').astype('object'))
+        f = np.logical_and(splabels == sid, valid)
+        if f.sum() > 0:
+            u, ix = np.unique(labels[f], return_inverse=True)
+            codes[f] = ix + offset
+            offset += u.size
+            clu.append(u)
+    return np.concatenate(clu), codes
+
+def _mapping_labels(sm, splabels, keys):
+    labels = np.array([None]*splabels.size, dtype='object')
+    for sid in keys.keys():
+        labels[splabels==sid] = sid+'_'+q(sm.sams[sid].adata.obs[keys[sid]]).astype('str').astype('object')
+    return labels
+
+def _cell_cluster_scores(X, splabels, codes, n_clusters):
+    # sums the cross-species edge weights of each cell per target cluster. `codes` and
+    # `n_clusters` may be lists, in which case all annotations are scored in one pass over `X`.
+    # edges into masked cells (code -1) are dropped through the indicator matrix. within-species
+    # edges are filtered on the CSR arrays of `X`, so only its cross-species entries are copied.
+    multi = isinstance(n_clusters, Iterable)
+    if not multi:
+        codes, n_clusters = [codes], [n_clusters]
+
+    X = sp.sparse.csr_matrix(X)
+    species = np.unique(splabels, return_inverse=True)[1]
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    filt = species[rows] != species[X.indices]
+    X = sp.sparse.csr_matrix(
+        (X.data[filt], X.indices[filt], np.append(0, np.cumsum(np.bincount(rows[filt], minlength=X.shape[0])))),
+        shape=X.shape)
+
+    offsets = np.append(0, np.cumsum(n_clusters))
+    cells = np.concatenate([np.where(c >= 0)[0] for c in codes])
+    cols = np.concatenate([c[c >= 0]+o for c,o in zip(codes,offsets)])
+    onehot = sp.sparse.coo_matrix(
+        (np.ones(cells.size), (cells, cols)), shape=(X.shape[0], offsets[-1])
+    ).tocsr()
+    S = X.dot(onehot).tocsc()
+    S = [S[:, offsets[i]:offsets[i+1]].tocsr() for i in range(len(codes))]
+    return S if multi else S[0]
+
+def _aggregate_csim(cell_cluster_scores, codes, n_clusters, n_tops, thr=None):
+    # if `thr` is passed, returns sparse matrices with entries below `thr` removed
+    CSIMs = [None]*len(n_tops)
+    cells = np.where(codes >= 0)[0]
+    codes = codes[cells]
+    if 0 in n_tops:
+        counts = np.bincount(codes, minlength=n_clusters)
+        onehot = sp.sparse.coo_matrix(
+            (1 / counts[codes], (codes, cells)), shape=(n_clusters, cell_cluster_scores.shape[0])
+        ).tocsr()
+        CSIM = onehot.dot(cell_cluster_scores)
+        if thr is None:
+            CSIM = CSIM.toarray()
         else:
-            cl.append(q(samap.adata.obs[key])[samap.adata.obs['species']==sid])            
-        clu.append(np.unique(cl[-1]))
+            CSIM.data[CSIM.data < thr] = 0
+            CSIM.eliminate_zeros()
+        for i, n in enumerate(n_tops):
+            if n <= 0:
+                CSIMs[i] = CSIM.copy()
+
+    tops = [n for n in n_tops if n > 0]
+    if len(tops) > 0:
+        if thr is None:
+            for i, n in enumerate(n_tops):
+                if n > 0:
+                    CSIMs[i] = np.zeros((n_clusters, n_clusters))
+        else:
+            X, Y, V = [[] for _ in n_tops], [[] for _ in n_tops], [[] for _ in n_tops]
+
+        # group the cells of each cluster into contiguous row blocks
+        order = np.argsort(codes, kind='stable')
+        bounds = np.append(0, np.cumsum(np.bincount(codes, minlength=n_clusters)))
+        S = cell_cluster_scores[cells[order]]
+        for c in range(n_clusters):
+            rows = S[bounds[c]:bounds[c+1]].toarray()
+            m = rows.shape[0]
+
+            # one partial selection serves every `n_top` requested
+            kth = np.unique([m - n for n in tops if n < m])
+            if kth.size > 0:
+                rows = np.partition(rows, kth, axis=0)
+            for i, n in enumerate(n_tops):
+                if n > 0:
+                    row = rows[-n:].mean(0)
+                    if thr is None:
+                        CSIMs[i][c, :] = row
+                    else:
+                        y = np.where(row >= thr)[0]
+                        X[i].append(np.zeros(y.size, dtype='int') + c)
+                        Y[i].append(y)
+                        V[i].append(row[y])
+
+        if thr is not None:
+            for i, n in enumerate(n_tops):
+                if n > 0:
+                    CSIMs[i] = sp.sparse.coo_matrix(
+                        (np.concatenate(V[i]), (np.concatenate(X[i]), np.concatenate(Y[i]))), shape=(n_clusters, n_clusters)
+                    ).tocsr()
+    return CSIMs
+
+def _csim_from_scores(cell_cluster_scores, codes, n_clusters, n_tops, mapping_K, sparse_thr=None):
+    if sparse_thr is not None:
+        if cell_cluster_scores.nnz > 0:
+            CSIMs = _aggregate_csim(cell_cluster_scores, codes, n_clusters, n_tops, thr=sparse_thr * mapping_K)
+            return [CSIM.maximum(CSIM.T).tocsr() / mapping_K for CSIM in CSIMs]
+        return [sp.sparse.csr_matrix((n_clusters, n_clusters)) for _ in n_tops]
+
+    if cell_cluster_scores.nnz > 0:
+        CSIMs = _aggregate_csim(cell_cluster_scores, codes, n_clusters, n_tops)
+        return [np.maximum(CSIM, CSIM.T) / mapping_K for CSIM in CSIMs]
+    return [np.zeros((n_clusters, n_clusters)) for _ in n_tops]
 
-    clu = np.concatenate(clu)
-    cl = np.concatenate(cl)
+def _compute_csim(samap, key, X=None, prepend=True, n_top = 0):
+    splabels = q(samap.adata.obs['species'])
+    labels = q(samap.adata.obs[key]).astype('str').astype('object')
+    if prepend:
+        labels = splabels.astype('object')+'_'+labels
+    clu, codes = _cluster_codes(splabels, labels)
+    n_tops = list(n_top) if isinstance(n_top, Iterable) else [n_top]
 
-    CSIM = np.zeros((clu.size, clu.size))
     if X is None:
-        X = samap.adata.obsp["connectivities"].copy()
-
-    xi,yi = X.nonzero()
-    spxi = splabels[xi]
-    spyi = splabels[yi]
-
-    filt = spxi!=spyi
-    di = X.data[filt]
-    xi = xi[filt]
-    yi = yi[filt]
-
-    px,py = xi,cl[yi]
-    p = px.astype('str').astype('object')+';'+py.astype('object')
-
-    A = pd.DataFrame(data=np.vstack((p, di)).T, columns=["x", "y"])
-    valdict = df_to_dict(A, key_key="x", val_key="y")   
-    cell_scores = [valdict[k].sum() for k in valdict.keys()]
-    ixer = pd.Series(data=np.arange(clu.size),index=clu)
-    if len(valdict.keys())>0:
-        xc,yc = substr(list(valdict.keys()),';')
-        xc = xc.astype('int')
-        yc=ixer[yc].values
-        cell_cluster_scores = sp.sparse.coo_matrix((cell_scores,(xc,yc)),shape=(X.shape[0],clu.size)).A
-
-        for i, c in enumerate(clu):
-            if n_top > 0:
-                CSIM[i, :] = np.sort(cell_cluster_scores[cl==c],axis=0)[-n_top:].mean(0)
-            else:
-                CSIM[i, :] = cell_cluster_scores[cl==c].mean(0)
-
-        CSIM = np.stack((CSIM,CSIM.T),axis=2).max(2)
-        CSIMth = CSIM / samap.adata.uns['mapping_K']
-        return CSIMth,clu
+        X = samap.adata.obsp["connectivities"]
+
+    cell_cluster_scores = _cell_cluster_scores(X, splabels, codes, clu.size)
+    CSIMs = _csim_from_scores(cell_cluster_scores, codes, clu.size, n_tops, samap.adata.uns['mapping_K'])
+
+    if isinstance(n_top, Iterable):
+        return CSIMs, clu
+    return CSIMs[0], clu
+
+def _highest_mapping_scores(A, n_hms=None, chunk_size=1024):
+    clu = q(A.columns)
+    if hasattr(A, 'sparse'):
+        M = A.sparse.to_coo().tocsc()
+        i = np.argsort(-M.max(0).toarray().flatten())
     else:
-        return np.zeros((clu.size, clu.size)), clu
+        M = A.values
+        i = np.argsort(-M.max(0).flatten())
+    k = clu.size if n_hms is None else min(n_hms, clu.size)
+
+    # top-k clusters of every column, processed in blocks of columns
+    H = np.zeros((k, 2*clu.size), dtype='object')
+    for s in range(0, clu.size, chunk_size):
+        cols = i[s:s+chunk_size]
+        V = M[:, cols]
+        V = V.toarray() if sp.sparse.issparse(V) else np.asarray(V)
+        if k < clu.size:
+            ix = np.argpartition(-V, k-1, axis=0)[:k]
+        else:
+            ix = np.tile(np.arange(clu.size)[:, None], (1, cols.size))
+        vals = np.take_along_axis(V, ix, axis=0)
+        o = np.argsort(-vals, axis=0, kind='stable')
+        ix = np.take_along_axis(ix, o, axis=0)
+        H[:, 2*s:2*(s+cols.size):2] = clu[ix]
+        H[:, 2*s+1:2*(s+cols.size):2] = np.take_along_axis(vals, o, axis=0)
+
+    C = np.repeat(clu[i], 2)
+    D = pd.DataFrame(data=H, columns=[C, ["Cluster","Alignment score"]*clu.size])
+    return D
+
+def _mapping_tables(CSIMs, clu, n_top, n_hms=None):
+    A = []
+    for CSIM in CSIMs:
+        if sp.sparse.issparse(CSIM):
+            A.append(pd.DataFrame.sparse.from_spmatrix(CSIM, index=clu, columns=clu))
+        else:
+            A.append(pd.DataFrame(data=CSIM, index=clu, columns=clu))
+    D = [_highest_mapping_scores(x, n_hms=n_hms) for x in A]
+    if isinstance(n_top, Iterable):
+        return dict(zip(n_top, D)), dict(zip(n_top, A))
+    return D[0], A[0]
 
-def get_mapping_scores(sm, keys, n_top = 0):
+def get_mapping_scores(sm, keys, n_top = 0, sparse_thr = None, n_hms = None):
     """Calculate mapping scores
     Parameters
     ----------
@@ -1509,77 +2499,216 @@ def get_mapping_scores(sm, keys, n_top = 0):
     
     keys: dict, annotation vector keys for at least two species with species identifiers as the keys
         e.g. {'pl':'tissue','sc':'tissue'}
+        If fewer species than are in `sm` are passed, the other species are masked out of the
+        connectivity graph.
     
-    n_top: int, optional, default 0
+    n_top: int or list of int, optional, default 0
         If `n_top` is 0, average the alignment scores for all cells in a pair of clusters.
         Otherwise, average the alignment scores of the top `n_top` cells in a pair of clusters.
         Set this to non-zero if you suspect there to be subpopulations of your cell types mapping
         to distinct cell types in the other species.
+        If a list is passed (e.g. [0, 20, 50, 100]), the cell x cluster scores are aggregated once
+        and shared across all values.
+
+    sparse_thr: float, optional, default None
+        If passed, mapping scores below `sparse_thr` are dropped and `A` is returned as a
+        sparse pandas.DataFrame (same index and columns). The dense clusters x clusters
+        matrix is never materialized.
+
+    n_hms: int, optional, default None
+        If passed, the table of highest mapping scores `D` only lists the top `n_hms`
+        clusters for each cluster instead of all of them.
     Returns
     -------
     D - table of highest mapping scores for cell types 
     A - pairwise table of mapping scores between cell types across species
+        If `n_top` is a list, `D` and `A` are dictionaries keyed by the `n_top` values.
     """
-    
+    samap = sm.samap
+    splabels = q(samap.adata.obs['species'])
+    skeys = splabels[np.sort(np.unique(splabels,return_index=True)[1])]
+    skeys = skeys[np.in1d(skeys, list(keys.keys()))]
 
-    if len(list(keys.keys()))<len(list(sm.sams.keys())):
-        samap = SAM(counts = sm.samap.adata[np.in1d(sm.samap.adata.obs['species'],list(keys.keys()))])
-    else:
-        samap=sm.samap
-    
-    clusters = []
-    ix = np.unique(samap.adata.obs['species'],return_index=True)[1]
-    skeys = q(samap.adata.obs['species'])[np.sort(ix)]
-    
-    for sid in skeys:
-        clusters.append(q([sid+'_'+str(x) for x in sm.sams[sid].adata.obs[keys[sid]]]))
-    
-    cl = np.concatenate(clusters)
-    l = "{}_mapping_scores".format(';'.join([keys[sid] for sid in skeys]))
-    samap.adata.obs[l] = pd.Categorical(cl)
-    
-    CSIMth, clu = _compute_csim(samap, l, n_top = n_top, prepend = False)
+    cl = _mapping_labels(sm, splabels, keys)
+    if len(list(keys.keys())) >= len(list(sm.sams.keys())):
+        l = "{}_mapping_scores".format(';'.join([keys[sid] for sid in skeys]))
+        samap.adata.obs[l] = pd.Categorical(cl)
+
+    n_tops = list(n_top) if isinstance(n_top, Iterable) else [n_top]
+    clu, codes = _cluster_codes(splabels, cl)
+    S = _cell_cluster_scores(samap.adata.obsp["connectivities"], splabels, codes, clu.size)
+    CSIMs = _csim_from_scores(S, codes, clu.size, n_tops, samap.adata.uns['mapping_K'], sparse_thr=sparse_thr)
+    return _mapping_tables(CSIMs, clu, n_top, n_hms=n_hms)
+
+
+def get_mapping_scores_multi(sm, keys_list, n_top = 0, sparse_thr = None, n_hms = None):
+    """Calculate mapping scores for several annotation key-sets at once.
+
+    All key-sets are scored in a single traversal of the cross-species connectivity
+    graph. Unlike `get_mapping_scores`, no annotation columns are written to
+    `sm.samap.adata.obs`.
+
+    Parameters
+    ----------
+    sm: SAMAP object
+
+    keys_list: list of dict, annotation vector keys keyed by species identifiers
+        e.g. [{'pl':'cluster','sc':'cluster'}, {'pl':'tissue','sc':'tissue'}]
+        Key-sets may cover different subsets of species.
+
+    n_top: int or list of int, optional, default 0
+        See `get_mapping_scores`.
+
+    sparse_thr: float, optional, default None
+        See `get_mapping_scores`.
+
+    n_hms: int, optional, default None
+        See `get_mapping_scores`.
+
+    Returns
+    -------
+    A list with one (D, A) tuple per key-set, as returned by `get_mapping_scores`.
+    """
+    samap = sm.samap
+    splabels = q(samap.adata.obs['species'])
+    n_tops = list(n_top) if isinstance(n_top, Iterable) else [n_top]
+
+    clus, codes = [], []
+    for keys in keys_list:
+        clu, c = _cluster_codes(splabels, _mapping_labels(sm, splabels, keys))
+        clus.append(clu)
+        codes.append(c)
+
+    scores = _cell_cluster_scores(samap.adata.obsp["connectivities"], splabels, codes, [clu.size for clu in clus])
+    results = []
+    for clu, c, S in zip(clus, codes, scores):
+        CSIMs = _csim_from_scores(S, c, clu.size, n_tops, samap.adata.uns['mapping_K'], sparse_thr=sparse_thr)
+        results.append(_mapping_tables(CSIMs, clu, n_top, n_hms=n_hms))
+    return results
+
+
+def get_pairwise_mapping_scores(sm, keys, n_top = 0, sparse_thr = None, n_hms = None):
+    """Calculate mapping scores for every pair of species.
+
+    The cell x cluster scores are computed once over all species in `keys`. Each species
+    pair is then obtained by masking the rows and columns of the other species, giving the
+    same result as calling `get_mapping_scores` with only that pair of keys.
+
+    Parameters
+    ----------
+    sm: SAMAP object
+
+    keys: dict, annotation vector keys keyed by species identifiers
+
+    n_top: int or list of int, optional, default 0
+        See `get_mapping_scores`.
+
+    sparse_thr: float, optional, default None
+        See `get_mapping_scores`.
+
+    n_hms: int, optional, default None
+        See `get_mapping_scores`.
+
+    Returns
+    -------
+    A dictionary of (D, A) tuples keyed by (species 1, species 2).
+    """
+    import itertools
+    samap = sm.samap
+    splabels = q(samap.adata.obs['species'])
+    n_tops = list(n_top) if isinstance(n_top, Iterable) else [n_top]
+
+    clu, codes = _cluster_codes(splabels, _mapping_labels(sm, splabels, keys))
+    clu_sp = q(substr(clu, '_', 0)) if clu.size > 0 else clu
+    S = _cell_cluster_scores(samap.adata.obsp["connectivities"], splabels, codes, clu.size)
 
-    A = pd.DataFrame(data=CSIMth, index=clu, columns=clu)
-    i = np.argsort(-A.values.max(0).flatten())
-    H = []
-    C = []
-    for I in range(A.shape[1]):
-        x = A.iloc[:, i[I]].sort_values(ascending=False)
-        H.append(np.vstack((x.index, x.values)).T)
-        C.append(A.columns[i[I]])
-        C.append(A.columns[i[I]])
-    H = np.hstack(H)
-    D = pd.DataFrame(data=H, columns=[C, ["Cluster","Alignment score"]*(H.shape[1]//2)])
-    return D, A
+    skeys = splabels[np.sort(np.unique(splabels,return_index=True)[1])]
+    skeys = skeys[np.in1d(skeys, list(keys.keys()))]
+    results = {}
+    for pair in itertools.combinations(skeys, 2):
+        cm = np.where(np.in1d(clu_sp, pair))[0]
+        ixer = np.zeros(clu.size, dtype='int') - 1
+        ixer[cm] = np.arange(cm.size)
+        c = codes.copy()
+        c[c >= 0] = ixer[c[c >= 0]]
+        CSIMs = _csim_from_scores(S[:, cm], c, cm.size, n_tops, samap.adata.uns['mapping_K'], sparse_thr=sparse_thr)
+        results[pair] = _mapping_tables(CSIMs, clu[cm], n_top, n_hms=n_hms)
+    return results
 
 
 def _knndist(nnma, k):
-    x, y = nnma.nonzero()
-    data = nnma.data
-    xc, cc = np.unique(x, return_counts=True)
-    cc2 = np.zeros(nnma.shape[0], dtype="int")
-    cc2[xc] = cc
-    cc = cc2
-    newx = []
-    newdata = []
-    for i in range(nnma.shape[0]):
-        newx.extend([i] * k)
-        newdata.extend(list(data[x == i]) + [0] * (k - cc[i]))
-    data = np.array(newdata)
-    val = data.reshape((nnma.shape[0], k))
+    nnma = sp.sparse.csr_matrix(nnma)
+    keep = nnma.data != 0
+    x = np.repeat(np.arange(nnma.shape[0]), np.diff(nnma.indptr))[keep]
+    data = nnma.data[keep]
+
+    # position of each stored entry within its row, rows padded with zeros up to `k`
+    indptr = np.append(0, np.cumsum(np.bincount(x, minlength=nnma.shape[0])))
+    pos = np.arange(x.size) - indptr[x]
+    val = np.zeros((nnma.shape[0], k), dtype=data.dtype)
+    val[x, pos] = data
     return val
 
 
+def _matrix_fingerprint(X):
+    """Hash of the shape, format and stored values of `X`, used to detect that a matrix has changed."""
+    import hashlib
+    h = hashlib.sha1()
+    h.update(repr((X.shape, str(X.dtype), type(X).__name__)).encode())
+    if sp.sparse.issparse(X):
+        X = X if X.format in ('csr', 'csc') else sp.sparse.csr_matrix(X)
+        for arr in (X.indptr, X.indices, X.data):
+            h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        h.update(np.ascontiguousarray(X).tobytes())
+    return h.hexdigest()
+
+def _gene_mean_var(sam, genes=None, layer=None):
+    """Per-gene mean and variance of `sam.adata.X` (or `layer`).
+    
+    The statistics are computed over the full matrix, without building a column-sliced
+    view, and then gathered for `genes`. Nothing is stored in `sam.adata`; callers that
+    reuse the statistics keep them themselves (see `GenePairFinder.update_gene_stats`).
+    
+    Parameters
+    ----------
+    sam - SAM object
+    
+    genes - array-like, optional, default None
+        Genes to return statistics for. Returns all genes by default.
+        
+    layer - str, optional, default None
+        Layer to use instead of `X`.
+        
+    Returns
+    -------
+    mean, var - numpy.ndarray
+    """
+    adata = sam.adata
+    X = adata.X if layer is None else adata.layers[layer]
+    if sp.sparse.issparse(X):
+        X = X if X.format in ('csr', 'csc') else sp.sparse.csr_matrix(X)
+        mu, var = sf.mean_variance_axis(X, axis=0)
+    else:
+        mu, var = np.asarray(X).mean(0), np.asarray(X).var(0)
+    if genes is not None:
+        genes = q(genes)
+        ix = adata.var_names.get_indexer(genes)
+        if (ix < 0).any():
+            raise KeyError('{} genes not found in var_names, e.g. {}'.format((ix < 0).sum(), genes[ix < 0][0]))
+        mu, var = mu[ix], var[ix]
+    return mu, var
+
 def _sparse_sub_standardize(X, mu, var, rows=False):
-    x, y = X.nonzero()
+    X = sp.sparse.csr_matrix(X)
     if not rows:
         Xs = X.copy()
-        Xs.data[:] = (X.data - mu[y]) / var[y]
+        Xs.data[:] = (X.data - mu[X.indices]) / var[X.indices]
     else:
         mu, var = sf.mean_variance_axis(X, axis=1)
         var = var ** 0.5
         var[var == 0] = 1
+        x = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
         Xs = X.copy()
         Xs.data[:] = (X.data - mu[x]) / var[x]
     Xs.data[Xs.data < 0] = 0
@@ -1590,12 +2719,9 @@ def _get_mu_std(sam3, sam1, sam2, knn=False):
     g1, g2 = ut.extract_annotation(sam3.adata.uns['gene_pairs'], 0, ";"), ut.extract_annotation(
         sam3.adata.uns['gene_pairs'], 1, ";"
     )
-    if knn:
-        mu1, var1 = sf.mean_variance_axis(sam1.adata[:, g1].layers["X_knn_avg"], axis=0)
-        mu2, var2 = sf.mean_variance_axis(sam2.adata[:, g2].layers["X_knn_avg"], axis=0)
-    else:
-        mu1, var1 = sf.mean_variance_axis(sam1.adata[:, g1].X, axis=0)
-        mu2, var2 = sf.mean_variance_axis(sam2.adata[:, g2].X, axis=0)
+    layer = "X_knn_avg" if knn else None
+    mu1, var1 = _gene_mean_var(sam1, g1, layer=layer)
+    mu2, var2 = _gene_mean_var(sam2, g2, layer=layer)
     var1[var1 == 0] = 1
     var2[var2 == 0] = 1
     var1 = var1 ** 0.5
@@ -14,7 +14,7 @@ from log_utils import log
 from typing import NamedTuple, Optional
 from pathlib import Path
 from samap.mapping import SAMAP
-from samap.analysis import get_mapping_scores, sankey_plot, chord_plot
+from samap.analysis import get_mapping_scores, get_mapping_scores_multi, sankey_plot, chord_plot
 import matplotlib.pyplot as plt
 import holoviews as hv
 
@@ -111,7 +111,8 @@ def save_mapping_scores(samap: SAMAP,
                         output_dir: str,
                         n_top=0,
                         hms_name='hms',
-                        pms_name='pms'):
+                        pms_name='pms',
+                        scores=None):
     """
     Save the highest mapping scores and pairwise mapping scores to CSV files.
 
@@ -122,11 +123,14 @@ def save_mapping_scores(samap: SAMAP,
         n_top (int, default=0): Average the alignment scores for the n top cells (0 averages all cells)
         hms_name (str, default='hms'): Name which the highest mapping scores table will be saved to.
         pms_name (str, default='pms'): Name which the pairwise mapping scores table will be saved to.
+        scores (tuple, default=None): Precomputed (hms, pms) tables to save instead of computing them.
 
     Returns:
         tuple (pandas.dataFrame): Highest mapping scores and pairwise mapping scores.
     """
-    hms, pms = get_mapping_scores(sm=samap, keys=keys, n_top=n_top)
+    if scores is None:
+        scores = get_mapping_scores(sm=samap, keys=keys, n_top=n_top)
+    hms, pms = scores
     hms_outfile = os.path.join(output_dir, f"{hms_name}.csv")
     try: # Save the highest mapping scores to csv
         log(f"  Attempting to save highest mapping scores to '{hms_outfile}'", "INFO")
@@ -145,6 +149,35 @@ def save_mapping_scores(samap: SAMAP,
     return hms, pms # Return the data frames
 
 
+# --------------------------------------------------
+def save_mapping_scores_multi(samap: SAMAP,
+                              key_sets: list,
+                              output_dir: str,
+                              n_top=0):
+    """
+    Save the highest and pairwise mapping scores for several annotation key-sets.
+
+    All key-sets are scored in a single pass. The first key-set is saved as 'hms.csv'
+    and 'pms.csv'; every further key-set is saved as 'hms_{annotations}.csv' and
+    'pms_{annotations}.csv'.
+
+    Args:
+        samap (SAMAP): The SAMAP object containing the results.
+        key_sets (list): List of annotation dictionaries, one per key-set.
+        output_dir (str): Directory where the results will be saved.
+        n_top (int, default=0): Average the alignment scores for the n top cells (0 averages all cells)
+
+    Returns:
+        list (tuple): Highest mapping scores and pairwise mapping scores for each key-set.
+    """
+    results = get_mapping_scores_multi(sm=samap, keys_list=key_sets, n_top=n_top)
+    for i, (keys, scores) in enumerate(zip(key_sets, results)):
+        suffix = "" if i == 0 else "_" + "_".join(dict.fromkeys(keys.values()))
+        save_mapping_scores(samap, keys, output_dir, n_top=n_top,
+                            hms_name=f"hms{suffix}", pms_name=f"pms{suffix}", scores=scores)
+    return results
+
+
 # --------------------------------------------------
 def save_sankey_plot(mapping_table, 
                     output_dir: str,
@@ -229,25 +262,41 @@ def save_scatter_plot(samap: SAMAP, output_dir: str, out_name='scatter', dpi=300
 
 
 # --------------------------------------------------
-def load_keys_from_sample_sheet(sample_sheet_path: Path) -> dict:
+def load_key_sets_from_sample_sheet(sample_sheet_path: Path) -> list:
     """
-    Load a dictionary of keys from the sample sheet CSV. The keys are 
-    mapped from id2 to their corresponding annotations.
+    Load a list of key dictionaries from the sample sheet CSV. The annotation 
+    column may list several annotation columns separated by ';' 
+    (e.g. 'cluster;tissue'), producing one key-set per listed column.
 
     Args:
         sample_sheet_path (Path): Path to the sample sheet CSV.
 
     Returns:
-        dict: Dictionary where the key is id2 and the value is the annotation.
+        list: List of dictionaries where the key is id2 and the value is the annotation.
+
+    Raises:
+        ValueError: If the sample sheet lists no samples or a sample has no annotation.
     """
-    keys = {}
+    annotations = {}
     with open(sample_sheet_path, newline="") as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
-            keys[row["id2"]] = row["annotation"]
-            log(f"  Loading annotation for {row['id2']}: {row['annotation']}", "INFO")
-    log("Successfully loaded all annotation keys")
-    return keys
+            annotations[row["id2"]] = [a.strip() for a in row["annotation"].split(";") if a.strip()]
+            log(f"  Loading annotations for {row['id2']}: {', '.join(annotations[row['id2']])}", "INFO")
+    if not annotations:
+        error_message = f"Sample sheet '{sample_sheet_path}' lists no samples"
+        log(error_message, "ERROR")
+        raise ValueError(error_message)
+    n_sets = min(len(a) for a in annotations.values())
+    if n_sets < max(len(a) for a in annotations.values()):
+        log(f"  Samples list different numbers of annotations, using the first {n_sets}", "WARNING")
+    if n_sets == 0:
+        error_message = f"Sample sheet '{sample_sheet_path}' has samples without an annotation"
+        log(error_message, "ERROR")
+        raise ValueError(error_message)
+    key_sets = [{sid: a[i] for sid, a in annotations.items()} for i in range(n_sets)]
+    log(f"Successfully loaded {n_sets} annotation key-set(s)")
+    return key_sets
 
 
 # --------------------------------------------------
@@ -269,11 +318,14 @@ def main() -> None:
     log(f"Attempting to load SAMAP pickle from '{args.input}'", "INFO")
     sm = load_samap_pickle(args.input)
     log(f"Attempting to load annotation keys from '{args.sample_sheet}'", "INFO")
-    keys = load_keys_from_sample_sheet(args.sample_sheet)
+    key_sets = load_key_sets_from_sample_sheet(args.sample_sheet)
     
     # Save and get mapping scores and use them to generate plots
     log("Attempting to save mapping scores")
-    _, pms = save_mapping_scores(sm, keys, args.output_dir)
+    if len(key_sets) > 1:
+        (_, pms), *_ = save_mapping_scores_multi(sm, key_sets, args.output_dir)
+    else:
+        _, pms = save_mapping_scores(sm, key_sets[0], args.output_dir)
     log("Attempting to create chord plot", "INFO")
     save_chord_plot(mapping_table=pms, output_dir=args.output_dir)
     log("Attempting to create sankey plot", "INFO")